@@ -1,40 +1,205 @@
-import sparse
 import numpy as np
 from tqdm import tqdm
 from scipy.stats import mode
+from itertools import repeat
+from mlopt.ParallelUtils import executor_scope, parallel_map
 import sys
-import itertools as it
+
+class MixedRadixSpace(object):
+    """
+        Cartesian product of dimentionsRanges, never materialized.
+
+        A vertex is the integer whose mixed radix digits are the positions of its values in every dimention,
+        the last dimention changing fastest, so vertices are numbered in the itertools.product order.
+        Rows are decoded on demand and keep int values, Space[v] or Space[v, :] is the row of vertex v.
+
+        Two vertices are neighbours when they differ in exactly one dimention.
+    """
+    def __init__(self, dimentionsRanges):
+        self._values = [np.arange(dimention.start, dimention.stop, dimention.step) if isinstance(dimention, range)
+                        else np.array(list(dimention), dtype=int) for dimention in dimentionsRanges]
+        self._radices = np.array([len(values) for values in self._values], dtype=np.int64)
+        if (self._radices == 0).any():
+            raise Exception("every dimention of dimentionsRanges must have at least one value")
+
+        size = 1
+        for radix in self._radices:
+            size *= int(radix)
+        if size >= 2**63:
+            raise Exception("the space has more vertices than an int64 index can address")
+
+        self._place = np.ones(len(self._radices), dtype=np.int64)
+        for d in range(len(self._radices) - 2, -1, -1):
+            self._place[d] = self._place[d + 1]*self._radices[d + 1]
+        self.shape = (size, len(self._radices))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "MixedRadixSpace({0} vertices, dimention sizes {1})".format(self.shape[0], self._radices.tolist())
+
+    def digits(self, index):
+        """
+            Mixed radix digits of index, one column per dimention. index can be an int or an array.
+        """
+        return (np.asarray(index, dtype=np.int64)[..., np.newaxis] // self._place) % self._radices
+
+    def decode(self, index):
+        """
+            Values of the vertex (or the vertices) index.
+        """
+        digits = self.digits(index)
+        return np.stack([values[digits[..., d]] for d, values in enumerate(self._values)], axis=-1)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.decode(key[0])[key[1:]]
+
+        return self.decode(key)
+
+    def randomNeighbour(self, index):
+        """
+            Uniform random neighbour of index, index itself when the space has a single vertex.
+        """
+        dimentions = np.flatnonzero(self._radices > 1)
+        if dimentions.shape[0] == 0:
+            return int(index)
+
+        d = np.random.choice(dimentions)
+        digit = int(self.digits(index)[d])
+        new_digit = np.random.randint(0, self._radices[d] - 1)
+        if new_digit >= digit:
+            new_digit += 1
+
+        return int(index) + (new_digit - digit)*int(self._place[d])
+
+class EdgeStore(object):
+    """
+        Edges of the sparse ACO graph kept in preallocated arrays, edge e goes from _source[e] to _target[e]
+        with distance _Dij[e] and pheromone _Tij[e]. The arrays double when full, so a tour allocates
+        nothing in the common case. _index maps (i, j) to e and _rows maps i to the edges leaving it,
+        in the order they were added.
+
+        An edge not stored has Dij = inf and the pheromone defaultTij, which evaporates with the stored ones.
+    """
+    def __init__(self, capacity=1024, defaultTij=1.0):
+        self._source = np.zeros(capacity, dtype=np.int64)
+        self._target = np.zeros(capacity, dtype=np.int64)
+        self._Dij = np.full(capacity, np.inf)
+        self._Tij = np.zeros(capacity)
+        self._size = 0
+        self._index = {}
+        self._rows = {}
+        self.defaultTij = defaultTij
+
+    def __len__(self):
+        return self._size
+
+    def __repr__(self):
+        return "EdgeStore({0} edges, {1} rows, defaultTij={2})".format(self._size, len(self._rows), self.defaultTij)
+
+    def grow(self):
+        """
+            Doubles the capacity of the edge arrays, keeping the stored edges.
+        """
+        capacity = 2*self._Dij.shape[0]
+        for name, fill in [('_source', 0), ('_target', 0), ('_Dij', np.inf), ('_Tij', 0.0)]:
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def edge(self, i, j):
+        """
+            Position of the edge (i, j), added with Dij = inf and the current defaultTij if not stored yet.
+        """
+        e = self._index.get((i, j))
+        if e is None:
+            if self._size == self._Dij.shape[0]:
+                self.grow()
+            e = self._size
+            self._size += 1
+            self._source[e] = i
+            self._target[e] = j
+            self._Dij[e] = np.inf
+            self._Tij[e] = self.defaultTij
+            self._index[(i, j)] = e
+            self._rows.setdefault(i, []).append(e)
+
+        return e
+
+    def setDij(self, i, j, value):
+        e = self.edge(i, j)
+        self._Dij[e] = value
+
+    def evaporate(self, rho):
+        """
+            Tij *= (1-rho) on every edge, in place.
+        """
+        self._Tij[:self._size] *= (1-rho)
+        self.defaultTij *= (1-rho)
+
+    def deposit(self, sources, targets, Q):
+        """
+            Adds Q/Dij to the stored edges (sources[a], targets[a]), once per pair, repeated pairs add up.
+            Edges not stored have Dij = inf and get nothing.
+        """
+        edges = np.fromiter((self._index.get((int(i), int(j)), -1) for i, j in zip(sources, targets)), dtype=np.int64,
+                            count=len(sources))
+        edges = edges[edges >= 0]
+        with np.errstate(divide='ignore'):
+            np.add.at(self._Tij, edges, Q/self._Dij[edges])
+
+    def rows(self, sources):
+        """
+            Targets, Dij and Tij of the edges leaving every source, laid end to end and gathered from the
+            edge arrays. Also returns the number of edges of every source.
+        """
+        lengths = np.array([len(self._rows.get(i, [])) for i in sources], dtype=np.int64)
+        edges = np.fromiter((e for i in sources for e in self._rows.get(i, [])), dtype=np.int64, count=lengths.sum())
+
+        return self._target[edges], self._Dij[edges], self._Tij[edges], lengths
 
 class ACO(object):
     """
         antNumber : number of ants
-        
+
         alpha : parameter for probabilities matrix
-        
+
         beta : parameter for probabilities matrix
-        
+
         rho : for pherormone
-        
+
         Q : for pherormone
-        
+
         dimentionsRanges : must be a list of itretables
-    
+
         fitenessFunction : must be like, and returns a float from 0 to inf, the smaller means the better
             result = fitenessFunction(self.Space(self.antsVertice[k_ant]), *fitnessFunctionArgs)
-            
-        fitnessFunctionArgs : args Diferent than the antsVertice in Space.    
+
+        fitnessFunctionArgs : args Diferent than the antsVertice in Space.
+
+        executor : how the new vertices of a tour are evaluated: 'serial', 'thread', 'process' or an already
+            created concurrent.futures.Executor, which is shared and not shut down. 'process' needs a picklable
+            fitnessFunction (defined at module level).
+
+        n_jobs : number of workers for 'thread' and 'process'. None uses all the cpus.
+
+        The space is a MixedRadixSpace and the graph is sparse: Dij and Tij live in an EdgeStore holding only
+        the edges the ants probed, so memory grows with the exploration, not with |space|^2. Pheromone is
+        evaporated and deposited in place and Pij is computed only for the rows where ants are.
     """
 
     fitnessFunctionArgs = None
 
-    def __init__(self, alpha, beta, rho, Q):
+    def __init__(self, alpha, beta, rho, Q, executor='serial', n_jobs=None):
         self._alpha = alpha
         self._beta = beta
         self._rho = rho
         self._Q = Q
-        self._Dij = None
+        self._edges = None
         self._Pij = None
-        self._Tij = None
         self._Space = None
         self._antsVertice = None
         self._oldAntsVertice = None
@@ -47,153 +212,246 @@ class ACO(object):
         self._dimentionsRanges = None
         self.fitnessFunction = None
         self._fitnessFunctionArgs = None
-    
+        self._fitnessRequested = 0
+        self._fitnessPerformed = 0
+        self._executor = executor
+        self._n_jobs = n_jobs
+        self._pool = None
+
     def setSpace(self):
         """
             Dimentions_Ranges: is a list of ranges. E.g:
                 p = d = q = range(0, 2)
                 Dimentions_Ranges = [p, d, q]
-                
+
             The vertices of the graph will be a line of Space
         """
 
-        Space = np.array(list(it.product(*self._dimentionsRanges)), dtype = np.int)
+        Space = MixedRadixSpace(self._dimentionsRanges)
+
+        return Space
 
-        return Space    
-    
     def initializeVerticesFitness(self):
-        return 1/np.zeros(self._Space.shape[0])
-    
+        """
+            Fitness of the vertices already evaluated, {vertex: fitness}.
+        """
+        return {}
+
     def initializeMatricesAndAntsPosition(self):
-        # TODO make with dynamic programming to prevent uncessary allocation of a lot o memory.
-        # maybe use float 32 dtype...    
         self._Space = self.setSpace()
         self._verticesFitness = self.initializeVerticesFitness()
-        self._Dij = 1/np.zeros((self._Space.shape[0], self._Space.shape[0]), dtype=np.float32)
-        self._Pif = sparse.COO(np.ones((self._Space.shape[0], self._Space.shape[0]), dtype=np.float32))
-        self._Tij = sparse.COO(np.ones((self._Space.shape[0], self._Space.shape[0]), dtype=np.float32))
-        
-        self._antsVertice = np.random.choice(range(self._Space.shape[0]), size=self._antNumber)
+        self._fitnessRequested = 0
+        self._fitnessPerformed = 0
+        self._edges = EdgeStore()
+        self._Pij = {}
+
+        self._antsVertice = np.random.randint(0, self._Space.shape[0], size=self._antNumber)
         self._oldAntsVertice = np.zeros(self._antNumber, dtype=int)
         self._ants_History = [None]*self._antTours
-    
-    def updateDij(self, Dij, verbose=False):
+
+    def vertexFitness(self, index):
+        """
+            Fitness of the vertex index. fitnessFunction only runs for vertices not evaluated before,
+            the others come from _verticesFitness.
+        """
+        self._fitnessRequested += 1
+        if index not in self._verticesFitness:
+            self._fitnessPerformed += 1
+            self._verticesFitness[index] = self.fitnessFunction(self._Space[index, :], self._fitnessFunctionArgs)
+
+        return self._verticesFitness[index]
+
+    def evaluateVertices(self, indices):
+        """
+            Evaluates the vertices of indices not evaluated before, once each and all at the same time
+            on the executor pool, and keeps their fitness in _verticesFitness.
+        """
+        new_vertices = [index for index in dict.fromkeys(indices) if index not in self._verticesFitness]
+        fitness = parallel_map(self.fitnessFunction, [self._Space[index, :] for index in new_vertices],
+                               repeat(self._fitnessFunctionArgs), executor=self._pool)
+        self._verticesFitness.update(zip(new_vertices, fitness))
+        self._fitnessPerformed += len(new_vertices)
+
+    def getFitnessCounts(self):
+        """
+            Returns the number of fitness evaluations requested by the ants and the number really performed.
+        """
+        return self._fitnessRequested, self._fitnessPerformed
+
+    def updateDij(self, edges, verbose=False):
         """
             Dij and Pij will be only the matrix for the current possibilities
             Tij will be the pherormonen matrix for the whole graph
-            
+
             fitnessFunction - lesser the better, so a good path should, Cj lesser than Ci
             Dij[i,j] = Exp((Cj-Ci)/Ci)
             Dij[j,i] = Exp((Ci-Cj)/Cj)
-            
+
             the random idea is like the ants cant get the distance perfectly
+
+            Every ant probes a random neighbour j of its vertex i. The (i, j) pairs of all the ants are
+            collected first and their new vertices evaluated as one batch (evaluateVertices).
         """
+        pairs = []
         for k_ant in range(self._antNumber):
-            i_index = self._antsVertice[k_ant]
-            j_index = np.random.choice(range(0, self._Space.shape[0]))
-            
+            i_index = int(self._antsVertice[k_ant])
+            pairs.append((i_index, self._Space.randomNeighbour(i_index)))
+
+        self.evaluateVertices([index for i_index, j_index in pairs if i_index != j_index for index in (i_index, j_index)])
+
+        for i_index, j_index in pairs:
             if i_index != j_index: # ant should not stay at the point
 
                 if verbose:
                     print("Setting fitness for")
                     print(self._Space[i_index, :])
 
-                Ci = self.fitnessFunction(self._Space[i_index, :], self._fitnessFunctionArgs)
-                self._verticesFitness[i_index] = Ci
+                Ci = self.vertexFitness(i_index)
 
                 if verbose:
                     print("fitness is")
                     print(Ci)
                     print("Setting fitness for")
                     print(self._Space[j_index, :])
-                
-                Cj = self.fitnessFunction(self._Space[j_index, :], self._fitnessFunctionArgs)
-                self._verticesFitness[j_index] = Cj
+
+                Cj = self.vertexFitness(j_index)
 
                 if verbose:
                     print("fitness is")
                     print(Cj)
-                    
-                Dij[i_index, j_index] = np.exp((Cj-Ci)/Ci)
-                Dij[j_index, i_index] = np.exp((Ci-Cj)/Cj)
-            
+
+                edges.setDij(i_index, j_index, np.exp((Cj-Ci)/Ci))
+                edges.setDij(j_index, i_index, np.exp((Ci-Cj)/Cj))
+
             else:
-                Dij[j_index, i_index] = sys.maxsize
-        
-        return Dij
-    
-                                          
-    def updateTij(self, Tij, Dij, Ants, last_Ants, rho=0.5, Q=1):
-        # Dij_inf = Dij == sys.maxsize
-        # Dij_notinf = Dij != sys.maxsize
-        # Dij[Dij_inf] = Dij_notinf.max()
-
-        sumdeltaTij = np.zeros(Tij.shape, dtype=np.float32)
-
-        for kij in zip(last_Ants, Ants):
-            sumdeltaTij[kij] += Q/Dij[kij]
-
-        Tij = (1-rho)*Tij + sumdeltaTij
-
-        Tij += np.random.randint(1, size=Tij.shape)/10
-
-        return Tij
-
-                                          
-    def updatePij(self, Pij, Tij, Dij, alpha=1, beta=1):
-        # Dij_inf = Dij == sys.maxsize
-        # Dij_notinf = Dij != sys.maxsize
-        # Dij[Dij_inf] = Dij_notinf.max()
-
-        Pij = (Tij**alpha)/(Dij**beta)
-        Pij += np.random.randint(1, size=Pij.shape)/10
-        
-        row_sums = Pij.sum(axis=1)
-        Pij = Pij / row_sums[:, np.newaxis]
-        
+                edges.setDij(j_index, i_index, sys.maxsize)
+
+        return edges
+
+    def updateTij(self, edges, Ants, last_Ants, rho=0.5, Q=1):
+        """
+            Evaporates every edge in place, the ones not stored through defaultTij, and deposits Q/Dij
+            on the edges the ants walked with a single scatter add.
+        """
+        edges.evaporate(rho)
+        edges.deposit(last_Ants, Ants, Q)
+
+        return edges
+
+    def updatePij(self, Pij, alpha=1, beta=1):
+        """
+            Transition probabilities, only for the rows where ants are now. The edges of all those rows are
+            gathered once and weighted and normalized together: Tij**alpha/Dij**beta over the row sum, so only
+            the edges with a finite Dij get a positive probability.
+        """
+        rows = [int(k) for k in np.unique(self._antsVertice)]
+        moves, Dk, Tk, lengths = self._edges.rows(rows)
+        row_of_edge = np.repeat(np.arange(len(rows)), lengths)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Pk = (Tk**alpha)/(Dk**beta)
+            Pk = Pk / np.bincount(row_of_edge, weights=Pk, minlength=len(rows))[row_of_edge]
+
+        bounds = np.cumsum(lengths)[:-1]
+        Pij = dict(zip(rows, zip(np.split(moves, bounds), np.split(Pk, bounds))))
+
         return Pij
 
 
     def getHistorySolutions(self):
         self._ants_History = list(filter(lambda x: not x is None, self._ants_History))
-        return self._ants_History, 
-    
+        return self._ants_History,
+
     def plotHistorySolutions(self):
         #TODO
         return 0
 
     def updateAntsPosition(self, Ants, Pij, verbose=False):
+        """
+            Moves all the ants at once. The possible moves of every row in Pij are laid end to end, row r
+            with its cumulative probabilities shifted by r, so one searchsorted of r + uniform draws samples
+            the next vertex of every ant, with the same distribution as a np.random.choice per ant.
+            Ants on a row without possible moves go to a uniform random vertex of the space.
+        """
         last_Ants = Ants.copy()
 
-        for i in range(Ants.shape[0]):
-            k = Ants[i]
+        rows = {}
+        moves, cumulative, starts, ends = [], [], [], []
+        size = 0
+        for r, k in enumerate(np.unique(Ants)):
+            row_moves, Pk = Pij[int(k)]
+            possible = Pk > 0
+            rows[int(k)] = r
+            starts.append(size)
+            if possible.any():
+                cumulative_k = np.cumsum(Pk[possible]/Pk[possible].sum())
+                cumulative_k[-1] = 1.0
+                moves.append(row_moves[possible])
+                cumulative.append(cumulative_k + r)
+                size += cumulative_k.shape[0]
+            ends.append(size)
 
-            possible_move = np.argwhere(Pij[k,:] > 0).flatten()
+        ant_rows = np.array([rows[int(k)] for k in Ants])
+        starts = np.array(starts)[ant_rows]
+        ends = np.array(ends)[ant_rows]
+        can_move = ends > starts
 
-            if possible_move.shape[0] != 0:
-                weights = Pij[k, possible_move]/Pij[k, possible_move].sum()
-                Ants[i] = np.random.choice(possible_move, p=weights)
-            else:
-                Ants[i] = np.random.choice(np.array(range(Pij.shape[1])))
+        if moves:
+            moves = np.concatenate(moves)
+            cumulative = np.concatenate(cumulative)
+            draws = ant_rows[can_move] + np.random.random_sample(can_move.sum())
+            chosen = np.searchsorted(cumulative, draws, side='right')
+            Ants[can_move] = moves[np.minimum(chosen, ends[can_move] - 1)]
 
-            if verbose:
+        Ants[~can_move] = np.random.randint(0, self._Space.shape[0], size=(~can_move).sum())
+
+        if verbose:
+            for i in range(Ants.shape[0]):
                 print("Ant {} possibilities:".format(i))
-                print(possible_move)
-                print("Ant {} move from {} to {}".format(i, k, Ants[i]))
+                print(moves[starts[i]:ends[i]] if can_move[i] else [])
+                print("Ant {} move from {} to {}".format(i, last_Ants[i], Ants[i]))
 
         return Ants, last_Ants
-    
-                                          
+
+
+    def tours(self, verbose=False):
+        for it in tqdm(range(self._antTours)):
+            self._edges = self.updateDij(self._edges, verbose)
+            if verbose:
+                print("Dij: ")
+                print(self._edges)
+
+            self._edges = self.updateTij(self._edges, self._antsVertice, self._oldAntsVertice, self._rho, self._Q)
+            if verbose:
+                print("Tij: ")
+                print(self._edges)
+
+            self._Pij = self.updatePij(self._Pij)
+            if verbose:
+                print("Pij:")
+                print(self._Pij)
+
+            self._antsVertice, self._oldAntsVertice = self.updateAntsPosition(self._antsVertice.copy(), self._Pij, verbose)
+            self._ants_History[it] = self._antsVertice.copy()
+
+            if verbose:
+                print("Dij and Tij: ")
+                print(self._edges)
+                print("Pij:")
+                print(self._Pij)
+                print("Ants now - then")
+                print(self._antsVertice, "-", self._oldAntsVertice)
+
     def optimize(self, antNumber, antTours, dimentionsRanges, function, functionArgs=[], verbose=False):
         """
             antNumber : Number of ants
-            
+
             antTours : Number of tours each ant will make on the graph
-            
+
             dimentionsRanges : Dimentions of the Graph, [[x1_min:x1_max],[x2_1, x2_2, x2_3, ...],...]
-            
+
             function : function to be optimized
-            
+
             functionArgs : *args of the function
         """
         self._antNumber = antNumber
@@ -207,40 +465,24 @@ class ACO(object):
             print("dimentions Ranges passed: ", self._dimentionsRanges)
             print("Space Created: ", self._Space)
             print("number of Space Possibilities (rows): ", self._Space.shape[0])
-        
-        for it in tqdm(range(self._antTours)):
-            self._Dij = self.updateDij(self._Dij, verbose)
-            if verbose:
-                print("Dij: ")
-                print(self._Dij)
-
-            self._Tij = self.updateTij(self._Tij, self._Dij, self._antsVertice, self._oldAntsVertice, self._rho, self._Q)
-            if verbose:
-                print("Tij: ")
-                print(self._Tij)
-
-            self._Pij = self.updatePij(self._Pij, self._Tij, self._Dij)
-            if verbose:
-                print("Pij:")
-                print(self._Pij)
-            
-            self._antsVertice, self._oldAntsVertice = self.updateAntsPosition(self._antsVertice.copy(), self._Pij, verbose)
-            self._ants_History[it] = self._antsVertice.copy()
 
-            if verbose:
-                print("Dij: ")
-                print(self._Dij)
-                print("Tij: ")
-                print(self._Tij)
-                print("Pij:")
-                print(self._Pij)
-                print("Ants now - then")
-                print(self._antsVertice, "-", self._oldAntsVertice)
+        with executor_scope(self._executor, self._n_jobs) as pool:
+            self._pool = pool
+            try:
+                self.tours(verbose)
+            finally:
+                self._pool = None
 
-        self._allBest = self._Space[np.argmin(self._verticesFitness)]
-        self._allBestFitness = self._verticesFitness.min()
+        if len(self._verticesFitness) > 0:
+            best = min(self._verticesFitness, key=self._verticesFitness.get)
+            self._allBest = self._Space[best]
+            self._allBestFitness = self._verticesFitness[best]
+        else:
+            self._allBest = self._Space[0]
+            self._allBestFitness = np.inf
         print("ACO-All Best Response: {0}. Fitness: {1}".format(self._allBest, self._allBestFitness))
+        print("Fitness evaluations requested: {0}. Performed: {1}".format(*self.getFitnessCounts()))
 
         self._ants_History = list(filter(lambda x: not x is None, self._ants_History))
 
-        return self._allBest, self._allBestFitness
\ No newline at end of file
+        return self._allBest, self._allBestFitness
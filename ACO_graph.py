@@ -1,4 +1,3 @@
-from numpy.random import choice
 from scipy import spatial
 import matplotlib.pyplot as plt
 import random
@@ -7,15 +6,6 @@ from tqdm import tqdm
 import numpy as np
 import sys
 
-class Formiga:
-    def __init__(self, ponto_atual):
-        self.ponto_atual = ponto_atual
-        self.rota = [ponto_atual]
-
-    def andar(self, ponto):
-        self.ponto_atual = ponto
-        self.rota.append(ponto)
-
 class Ponto:
     def __init__(self, x, y):
         self.x = x
@@ -27,15 +17,6 @@ class Caminho:
         self.ponto_j = ponto_j
         self.comprimento = math.sqrt((ponto_i.x - ponto_j.x)**2 + (ponto_i.y - ponto_j.y)**2)
         self.feromonio = 0
-        self.formigas_passantes = []
-
-    def contem(self, formiga, qtd_pontos):
-        if self.ponto_i == formiga.ponto_atual:
-            return self.ponto_j not in formiga.rota or (len(formiga.rota) == qtd_pontos and self.ponto_j == formiga.rota[0])
-        elif self.ponto_j == formiga.ponto_atual:
-            return self.ponto_i not in formiga.rota or (len(formiga.rota) == qtd_pontos and self.ponto_i == formiga.rota[0])
-        else:
-            return False
 
     def ponto_adjacente(self, ponto):
         if self.ponto_i == ponto:
@@ -50,38 +31,88 @@ class Grafo:
         self.caminhos = caminhos
         self.melhor_rota = []
 
-    def possiveis_caminhos(self, formiga, qtd_pontos):
-        return [caminho for caminho in self.caminhos if caminho.contem(formiga, qtd_pontos)]
-
 class ACO_Graph:
     """
-    pontos_list - is a list of lists. where each lists is a point in R2 space.
+    pontos_list - is a list of lists. where each lists is a point in R2 space. The points must be distinct,
+        a route between two points at the same coordinates would have no length.
+    n_candidatos - None to choose every step among all the points not visited yet. An int k keeps a candidate list
+        of the k nearest points of every point, from a KD-tree built once, and the ants choose among their unvisited
+        candidates, falling back to all the unvisited points only when every candidate was visited.
+        Steps then cost O(k) instead of O(qtd_pontos), for large sets of points.
+
+    The graph is kept as (qtd_pontos x qtd_pontos) matrices indexed by the position of the points in pontos_list:
+    distancias, heuristica = (1/distancias)**beta and feromonios. A route is an array of point indices.
+    The Caminho objects of caminhos and grafo are only built when asked for, e.g. by plotGraphs.
     """
-    def __init__(self, pontos_list, alpha, beta, rho):
+    def __init__(self, pontos_list, alpha, beta, rho, n_candidatos=None):
         self.qtd_pontos = len(pontos_list)
         self.pontos = list(map(lambda p: Ponto(p[0],p[1]), pontos_list))
-        self.caminhos = self.init_caminhos()
-        self.grafo = Grafo(self.caminhos)
+        self.coordenadas = np.array([[ponto.x, ponto.y] for ponto in self.pontos], dtype=float).reshape(-1, 2)
         self.alfa = alpha
         self.beta = beta
         self.rho = rho
+        self.distancias = spatial.distance.cdist(self.coordenadas, self.coordenadas)
+        if np.count_nonzero(self.distancias == 0) > self.qtd_pontos:
+            raise Exception("pontos_list - every point must be at different coordinates, remove the repeated points")
+        self.heuristica = self.init_heuristica()
+        self.feromonios = np.zeros((self.qtd_pontos, self.qtd_pontos))
+        self.n_candidatos = n_candidatos
+        self.candidatos = self.init_candidatos()
+        self._pesos = None
         self.ants_number = None
         self.historico = []
         self.melhor_rota = None
 
+    def init_heuristica(self):
+        """
+            (1/distancia)**beta between every pair of points, 0 from a point to itself.
+        """
+        heuristica = np.zeros((self.qtd_pontos, self.qtd_pontos))
+        distintos = ~np.eye(self.qtd_pontos, dtype=bool)
+        heuristica[distintos] = (1 / self.distancias[distintos])**self.beta
+
+        return heuristica
+
+    def init_candidatos(self):
+        """
+            (qtd_pontos x n_candidatos) indices of the nearest points of every point, not counting itself.
+            None when n_candidatos is None.
+        """
+        if self.n_candidatos is None:
+            return None
+        elif self.n_candidatos < 1:
+            raise Exception("n_candidatos - must be None or at least 1")
+
+        k = min(self.n_candidatos, self.qtd_pontos - 1)
+        indices = np.arange(self.qtd_pontos)
+        _, vizinhos = spatial.cKDTree(self.coordenadas).query(self.coordenadas, k=k + 1)
+        vizinhos = vizinhos.reshape(self.qtd_pontos, -1)
+
+        # the points are distinct, so every point is among its own k + 1 nearest and is dropped
+        return vizinhos[vizinhos != indices[:, None]].reshape(self.qtd_pontos, k)
+
     def init_caminhos(self):
         # criando os caminhos
         caminhos = []
 
         for i in range(self.qtd_pontos - 1):
             ponto_atual = self.pontos[i]
-            pontos_para_conectar = self.pontos[i + 1:]
 
-            for ponto_para_conectar in pontos_para_conectar:
-                caminhos.append(Caminho(ponto_atual, ponto_para_conectar))
+            for j in range(i + 1, self.qtd_pontos):
+                caminho = Caminho(ponto_atual, self.pontos[j])
+                caminho.feromonio = self.feromonios[i, j]
+                caminhos.append(caminho)
 
         return caminhos
 
+    @property
+    def caminhos(self):
+        return self.init_caminhos()
+
+    @property
+    def grafo(self):
+        return Grafo(self.caminhos)
+
     def plotGraphs(self, fig_size=(20,10), text_size=14, marker='o', points_color='r', line_colors='k', line_marker='>'):
         plt.figure(figsize=fig_size)
 
@@ -112,69 +143,131 @@ class ACO_Graph:
         plt.show()
 
     def inicializar_colonia(self, ants_number):
-        formigas = []
+        """
+            Starting point of every ant.
+        """
+        return np.array([random.randrange(self.qtd_pontos) for _ in range(ants_number)], dtype=np.int64)
 
-        for _ in range(ants_number):
-            formigas.append(Formiga(random.choice(self.pontos)))
+    def atualizar_pesos(self):
+        """
+            feromonio**alfa * (1/comprimento)**beta of every edge, computed once per iteration. With candidate
+            lists only the (qtd_pontos x n_candidatos) weights of the candidate edges.
+        """
+        if self.candidatos is None:
+            if self._pesos is None:
+                self._pesos = np.zeros((self.qtd_pontos, self.qtd_pontos))
+            np.power(self.feromonios, self.alfa, out=self._pesos)
+            self._pesos *= self.heuristica
+        else:
+            linhas = np.arange(self.qtd_pontos)[:, None]
+            self._pesos = self.feromonios[linhas, self.candidatos]**self.alfa * self.heuristica[linhas, self.candidatos]
 
-        return formigas
+    def escolher_proximos(self, atuais, disponiveis):
+        """
+            Next point of every ant, drawn with the weights of the row of its current point over the points
+            still available to it (disponiveis, one 0/1 row per ant). With candidate lists the draw is over the
+            unvisited candidates of the current point, or over the whole row for the ants that visited them all.
+        """
+        if self.candidatos is None:
+            return self.sortear(self._pesos[atuais], disponiveis)
 
-    def escolher_caminho(self,possiveis_caminhos):
-        denominador = sum([(caminho.feromonio)**self.alfa * (1 / caminho.comprimento)**self.beta for caminho in possiveis_caminhos])
-        distribuicao_probabilidades = None
+        proximos = np.empty(len(atuais), dtype=np.int64)
+        candidatos = self.candidatos[atuais]
+        candidatos_disponiveis = disponiveis[np.arange(len(atuais))[:, None], candidatos]
+        com_candidatos = candidatos_disponiveis.any(axis=1)
 
-        if denominador == 0:
-            distribuicao_probabilidades = [1 / len(possiveis_caminhos)  for _ in possiveis_caminhos]
-        else:
-            distribuicao_probabilidades = [((caminho.feromonio)**self.alfa * (1 / caminho.comprimento)**self.beta) / denominador for caminho in possiveis_caminhos]
+        if com_candidatos.any():
+            escolhidos = self.sortear(self._pesos[atuais[com_candidatos]], candidatos_disponiveis[com_candidatos])
+            proximos[com_candidatos] = candidatos[com_candidatos, escolhidos]
 
-        return choice(possiveis_caminhos, 1, p=distribuicao_probabilidades)[0]
+        sem_candidatos = ~com_candidatos
+        if sem_candidatos.any():
+            pesos = self.feromonios[atuais[sem_candidatos]]**self.alfa * self.heuristica[atuais[sem_candidatos]]
+            proximos[sem_candidatos] = self.sortear(pesos, disponiveis[sem_candidatos])
+
+        return proximos
+
+    def sortear(self, pesos, disponiveis):
+        """
+            Column drawn from every row of pesos over its columns available in disponiveis, uniformly among
+            them when their weights are all 0.
+        """
+        pesos = pesos * disponiveis
+        acumulado = np.cumsum(pesos, axis=1)
+        sem_peso = acumulado[:, -1] == 0
+        if sem_peso.any():
+            acumulado[sem_peso] = np.cumsum(disponiveis[sem_peso], axis=1)
+
+        total = acumulado[:, -1]
+        sorteio = np.minimum(np.random.random_sample(len(pesos)) * total, np.nextafter(total, 0))
+
+        return np.argmax(acumulado > sorteio[:, None], axis=1)
+
+    def construir_rotas(self, inicio):
+        """
+            Routes of all the ants at once, they move a step together until every point is visited and then go
+            back to their starting point inicio. Returns the (ants_number x qtd_pontos + 1) point indices and
+            the length of every route, summed step by step while the ants move.
+        """
+        formigas = np.arange(len(inicio))
+        rotas = np.empty((len(inicio), self.qtd_pontos + 1 if self.qtd_pontos > 1 else 1), dtype=np.int64)
+        rotas[:, 0] = inicio
+        comprimentos = np.zeros(len(inicio))
+        disponiveis = np.ones((len(inicio), self.qtd_pontos))
+        disponiveis[formigas, inicio] = 0
+
+        for passo in range(1, self.qtd_pontos):
+            rotas[:, passo] = self.escolher_proximos(rotas[:, passo - 1], disponiveis)
+            disponiveis[formigas, rotas[:, passo]] = 0
+            comprimentos += self.distancias[rotas[:, passo - 1], rotas[:, passo]]
+
+        if self.qtd_pontos > 1:
+            rotas[:, -1] = inicio
+            comprimentos += self.distancias[rotas[:, -2], inicio]
+
+        return rotas, comprimentos
 
     def distancia_rota(self,rota):
-        distancia_rota = 0
+        """
+            Length of a route of point indices.
+        """
+        rota = np.asarray(rota, dtype=np.int64)
 
-        for i in range(0, len(rota) - 1):
-            distancia = math.sqrt((rota[i].x - rota[i + 1].x)**2 + (rota[i].y - rota[i + 1].y)**2)
-            distancia_rota += distancia
+        return float(self.distancias[rota[:-1], rota[1:]].sum())
 
-        return distancia_rota
+    def atualizar_feromonios(self, rotas, comprimentos, method, tal_saturation):
+        """
+            Every ant deposits 1/comprimento (the length of its route) on the edges it crossed, once per crossing.
+            The crossings of all the ants are laid end to end, both directions of every edge, and added with
+            a single scatter add.
+        """
+        origens = np.concatenate([rotas[:, :-1].ravel(), rotas[:, 1:].ravel()])
+        destinos = np.concatenate([rotas[:, 1:].ravel(), rotas[:, :-1].ravel()])
+        with np.errstate(divide='ignore'):
+            delta_tau = np.tile(np.repeat(1 / comprimentos, rotas.shape[1] - 1), 2)
 
-    def atualizar_feromonios(self, caminhos, method, tal_saturation):
         if method == 'aco':
-            for caminho in caminhos:
-                delta_tau = sum([1 / self.distancia_rota(formiga.rota) for formiga in caminho.formigas_passantes])
-                caminho.feromonio = (1 - self.rho) * caminho.feromonio + delta_tau
-                caminho.formigas_passantes = []
-        
+            self.feromonios *= (1 - self.rho)
+            np.add.at(self.feromonios, (origens, destinos), delta_tau)
+
         elif method == 'max_min':
             if tal_saturation == None:
-                mean_feromonio = np.mean([caminho.feromonio for caminho in caminhos])
+                qtd_caminhos = max(self.qtd_pontos*(self.qtd_pontos - 1), 1)
+                mean_feromonio = (self.feromonios.sum() - np.trace(self.feromonios)) / qtd_caminhos
                 tal_saturation = [0.2*mean_feromonio, 1.25*mean_feromonio]
-            
-            for caminho in caminhos:
-                lista_delta_tau = [1 / self.distancia_rota(formiga.rota) for formiga in caminho.formigas_passantes]
-                if len(lista_delta_tau) > 0:
-                    delta_tau = max(lista_delta_tau)*len(caminho.formigas_passantes) #essa soma vale para todas as formigas que passam nesse caminho
-                else:
-                    delta_tau = 0                    
-                
-                # mesma coisa vale para a saturacao, ela eh para a soma toda das formigas no caminho
-                caminho.feromonio += np.clip((1 - self.rho) * caminho.feromonio + delta_tau, a_min=min(tal_saturation)*len(caminho.formigas_passantes), a_max=max(tal_saturation)*len(caminho.formigas_passantes))
-                caminho.formigas_passantes = []
-        else:
-            raise Exception("method - chose insert 'aco' to use canonical ACO. Insert 'max_min' to use max_min ant system method")
-
-    def movimentar_formiga(self, formiga, grafo):
-        while True:
-            possiveis_caminhos = grafo.possiveis_caminhos(formiga, self.qtd_pontos)
-
-            if possiveis_caminhos == []:
-                break
 
-            caminho_escolhido = self.escolher_caminho(possiveis_caminhos)
-            caminho_escolhido.formigas_passantes.append(formiga)
-            formiga.andar(caminho_escolhido.ponto_adjacente(formiga.ponto_atual))
+            # caminhos sem formigas ficam como estao
+            caminhos, passagem, passagens = np.unique(origens*self.qtd_pontos + destinos, return_inverse=True, return_counts=True)
+            maior_delta = np.zeros(len(caminhos))
+            np.maximum.at(maior_delta, passagem, delta_tau)
+            feromonios = self.feromonios.reshape(-1)
 
+            #essa soma vale para todas as formigas que passam nesse caminho
+            delta_tau = maior_delta*passagens
+            # mesma coisa vale para a saturacao, ela eh para a soma toda das formigas no caminho
+            feromonios[caminhos] += np.clip((1 - self.rho) * feromonios[caminhos] + delta_tau, a_min=min(tal_saturation)*passagens, a_max=max(tal_saturation)*passagens)
+        else:
+            raise Exception("method - chose insert 'aco' to use canonical ACO. Insert 'max_min' to use max_min ant system method")
 
     def search(self, ants_number, iteracoes, plot_at_every = 100, method = 'aco', tal_saturation=None):
         """
@@ -189,16 +282,15 @@ class ACO_Graph:
         plot_follow = plot_at_every
 
         for it in tqdm(range(iteracoes)):
-            formigas = self.inicializar_colonia(self.ants_number)
-
-            for formiga in formigas:
-                self.movimentar_formiga(formiga, self.grafo)
+            self.atualizar_pesos()
+            rotas, comprimentos = self.construir_rotas(self.inicializar_colonia(self.ants_number))
 
-                if self.distancia_rota(formiga.rota) < distancia_melhor_rota:
-                    self.melhor_rota = formiga.rota
-                    distancia_melhor_rota = self.distancia_rota(formiga.rota)
+            melhor = int(np.argmin(comprimentos)) if len(rotas) > 0 else None
+            if melhor is not None and comprimentos[melhor] < distancia_melhor_rota:
+                self.melhor_rota = [self.pontos[i] for i in rotas[melhor]]
+                distancia_melhor_rota = float(comprimentos[melhor])
 
-            self.atualizar_feromonios(self.grafo.caminhos, method, tal_saturation)
+            self.atualizar_feromonios(rotas, comprimentos, method, tal_saturation)
 
             if plot_at_every == None:
                 pass
@@ -3,14 +3,22 @@ from sklearn.model_selection import train_test_split
 from sklearn.ensemble import VotingRegressor
 from sklearn.datasets import make_regression
 from sklearn import preprocessing
-from mlopt.AgMlp import AgMlp as Ag_mlp
+from mlopt.AgMlp import AgMlp as Ag_mlp, data_fingerprint
+from mlopt.LagFeatureStore import LagFeatureStore
+from mlopt.ParallelUtils import executor_scope
+from contextlib import contextmanager
+import time
+import os
+import pickle
+import tempfile
 import numpy as np
 import random
 from tqdm import tqdm
 
 class AGMLP_Residual:
     # TODO documentar
-    def __init__(self, data, y_sarimax, num_epochs = 10, size_pop=10, prob_mut=0.8, tr_ts_percents=[80,20], alpha_stop=1e-4):
+    def __init__(self, data, y_sarimax, num_epochs = 10, size_pop=10, prob_mut=0.8, tr_ts_percents=[80,20], alpha_stop=1e-4,
+                 residual_cache=None, scheduler=None, executor='serial', n_jobs=None):
         """
             data - original data
             y_sarimax - forecasted data
@@ -19,6 +27,14 @@ class AGMLP_Residual:
             prob_mut - probability of mutation
             tr_ts_percents - list of train and test percentages. E.G: [80,20]
             alpha_stop - early stop criteria.
+            residual_cache - dict where the residue models are kept by residue lag. Pass the same dict to share it
+                between searches, entries are keyed by a fingerprint of the data and GA settings too.
+            scheduler - SearchScheduler with a budget of fits and/or seconds for the whole search. The inner searches
+                get generations and population from it, less for weaker individuals, and the search stops when
+                the budget is over. The spend per level is kept in _budget_report. None runs full inner searches.
+            executor - 'serial', 'thread', 'process' or a concurrent.futures.Executor. One pool is opened for the
+                whole search and passed down to every inner search, which fits its models on it.
+            n_jobs - number of workers for 'thread' and 'process'. None uses all the cpus.
         """
         self._data = data
         self._data_train = data[:int(tr_ts_percents[0]/100*len(data))]
@@ -34,6 +50,21 @@ class AGMLP_Residual:
         self._alpha_stop = alpha_stop
         self._fitness_array = np.array([])
         self._best_of_all = None
+        self._erro_lags = LagFeatureStore(self._erro, tr_ts_percents=tr_ts_percents)
+        self._y_sarimax_lags = LagFeatureStore(self._y_sarimax, tr_ts_percents=tr_ts_percents)
+        self._residual_cache = residual_cache if residual_cache is not None else {}
+        self._association_cache = {}
+        self._scheduler = scheduler
+        self._inner_generations = num_epochs
+        self._inner_size_pop = size_pop
+        self._ranked = False
+        self._n_fits = 0
+        self._budget_report = None
+        self._executor = executor
+        self._n_jobs = n_jobs
+        self._pool = None
+        self._residual_fingerprint = (type(self).__name__, data_fingerprint(self._erro),
+                                      str((num_epochs, size_pop, prob_mut, tr_ts_percents)))
         
     def early_stop(self):
         array = self._fitness_array
@@ -46,54 +77,33 @@ class AGMLP_Residual:
 
         return to_break
         
+    def lag_store(self, serie):
+        """
+            LagFeatureStore of serie. The residue and sarimax series keep theirs for the whole search,
+            any other serie (e.g. the estimated residue) gets a new one.
+        """
+        if serie is self._erro:
+            return self._erro_lags
+        elif serie is self._y_sarimax:
+            return self._y_sarimax_lags
+
+        return LagFeatureStore(serie, tr_ts_percents=self._tr_ts_percents)
+
     def train_test_split(self, serie, num_lags, print_shapes = False):
         """
             Slipts a time series to train and test Data.
             X data are data num_lags behind y data.
+            Returned arrays are read only views shared between calls.
         """
-        len_serie = len(serie)
-        X = np.zeros((len_serie, num_lags))
-        y = np.zeros((len_serie,1))
-        for i in np.arange(0, len_serie):
-            if i-num_lags>0:
-                X[i,:] = serie[i-num_lags:i]
-                y[i] = serie[i]
-
-        len_train = np.floor(len_serie*self._tr_ts_percents[0]/100).astype('int')
-        len_test = np.ceil(len_serie*self._tr_ts_percents[1]/100).astype('int')
-
-        X_train = X[0:len_train]
-        y_train = y[0:len_train]
-        X_test = X[len_train:len_train+len_test]
-        y_test = y[len_train:len_train+len_test]
-
-        return X_train, y_train, X_test, y_test
+        return self.lag_store(serie).train_test_split(num_lags)
 
     def train_test_split_prev(self, serie, num_lags_pass, num_lags_fut, print_shapes = False):
         """
             Slipts a time series to train and test Data.
             X data are data num_lags_pass behind and num_lags_fut ahead y data.
+            Returned arrays are read only views shared between calls.
         """
-        len_serie = len(serie)
-        X = np.zeros((len_serie, (num_lags_pass+num_lags_fut)))
-        y = np.zeros((len_serie,1))
-        for i in np.arange(0, len_serie):
-            if (i-num_lags_pass > 0) and ((i+num_lags_fut) <= len_serie):
-                X[i,:] = serie[i-num_lags_pass:i+num_lags_fut]
-                y[i] = serie[i]
-            elif (i-num_lags_pass > 0) and ((i+num_lags_fut) > len_serie):
-                X[i,-num_lags_pass:] = serie[i-num_lags_pass:i]
-                y[i] = serie[i]
-
-        len_train = np.floor(len_serie*self._tr_ts_percents[0]/100).astype('int')
-        len_test = np.ceil(len_serie*self._tr_ts_percents[1]/100).astype('int')
-
-        X_train = X[0:len_train]
-        y_train = serie[0:len_train]
-        X_test = X[len_train:len_train+len_test]
-        y_test = y[len_train:len_train+len_test]
-
-        return X_train, y_train, X_test, y_test
+        return self.lag_store(serie).train_test_split_prev(num_lags_pass, num_lags_fut)
     
     def gen_population(self):
         """
@@ -110,36 +120,136 @@ class AGMLP_Residual:
         
         return population
 
+    def search_residual_model(self, lag):
+        """
+            Searches the model of the residue with lag past values.
+            Returns the best model and the residue it estimates for the whole serie.
+        """
+        erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida = self.train_test_split(self._erro, lag)
+
+        Ag_mlp_erro = Ag_mlp(erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida, self._inner_generations,
+            self._inner_size_pop, self._prob_mut, executor=self._pool).search_best_individual()
+        best_erro = Ag_mlp_erro._best_of_all
+        self._n_fits += Ag_mlp_erro._n_fits
+
+        erro_estimado = np.concatenate([best_erro.predict(erro_train_entrada), best_erro.predict(erro_test_entrada)])
+
+        return best_erro, erro_estimado
+
+    def memo_search(self, cache, key, level, search, *args):
+        """
+            Memoized inner search, charged to level ('residual' or 'association'). cache[key] holds
+            (effort, search(*args)), where effort is the (generations, population) of the inner searches it ran
+            with. It is reused only when that effort is at least the current one, so a search made with the
+            reduced effort of a low ranked individual runs again, and is replaced, for a better ranked one.
+            Returns (effort, result).
+        """
+        effort = (self._inner_generations, self._inner_size_pop)
+        if key not in cache or any(cached < asked for cached, asked in zip(cache[key][0], effort)):
+            fits, start = self._n_fits, time.time()
+            cache[key] = (effort, search(*args))
+            self.spend(level, self._n_fits - fits, time.time() - start)
+
+        return cache[key]
+
+    def residual_model(self, lag):
+        """
+            Memoized search_residual_model, see memo_search. The residue search only depends on the lag,
+            so the model and its estimated residue are reused by every individual with that lag.
+            Returns (effort, (model, estimated residue)).
+        """
+        return self.memo_search(self._residual_cache, self._residual_fingerprint + (int(lag),), 'residual',
+                                self.search_residual_model, lag)
+
+    def association_inputs(self, individual, erro_estimado):
+        """
+            Builds the association train and test inputs: the sarimax lags and the
+            past and future lags of the estimated residue.
+        """
+        X_ass_1_train_in, _, X_ass_1_test_in, _ = self.train_test_split(self._y_sarimax, individual[1])
+        X_ass_2_train_in, _, X_ass_2_test_in, _ = self.train_test_split_prev(erro_estimado, individual[2], individual[3])
+
+        X_in_train = np.concatenate((X_ass_1_train_in, X_ass_2_train_in), axis=1)
+        X_in_test = np.concatenate((X_ass_1_test_in, X_ass_2_test_in), axis=1)
+
+        return X_in_train, X_in_test
+
+    def search_association_model(self, X_in_train, X_in_test):
+        """
+            Searches the model that associates the sarimax and the estimated residue to the original data.
+        """
+        Ag_MLP_ass = Ag_mlp(X_in_train, self._data_train, X_in_test, self._data_test, self._inner_generations,
+                                 self._inner_size_pop, self._prob_mut, executor=self._pool).search_best_individual()
+        self._n_fits += Ag_MLP_ass._n_fits
+
+        return Ag_MLP_ass._best_of_all
+
+    def association_model(self, individual, erro_estimado):
+        """
+            Searches the association model of individual. Returns the model and its MAE.
+        """
+        X_in_train, X_in_test = self.association_inputs(individual, erro_estimado)
+        best_ass = self.search_association_model(X_in_train, X_in_test)
+
+        return best_ass, mae(best_ass.predict(X_in_test), self._data_test)
+
+    @contextmanager
+    def pool_scope(self):
+        """
+            Opens the pool shared by the inner searches, with one BLAS/OpenMP thread per task.
+        """
+        with executor_scope(self._executor, self._n_jobs, inner_threads=1) as pool:
+            self._pool = pool
+            try:
+                yield pool
+            finally:
+                self._pool = None
+
+    def spend(self, level, fits, seconds):
+        if self._scheduler is not None:
+            self._scheduler.spend(level, fits, seconds)
+
+    def prepare_inner_search(self, i, start_set_fit, len_pop):
+        """
+            Sets the generations and population of the inner searches of individual i from the scheduler.
+            Once the population is sorted, the position of i is used as its rank.
+        """
+        if self._scheduler is None:
+            return time.time()
+
+        if self._ranked:
+            rank, n_candidates = i - start_set_fit, len_pop - start_set_fit
+        else:
+            rank, n_candidates = 0, 1
+        self._inner_generations, self._inner_size_pop = self._scheduler.inner_settings(
+            self._num_epochs, self._size_pop, 2, rank, n_candidates)
+
+        return time.time()
+
+    def evaluated(self, start):
+        if self._scheduler is not None:
+            self._scheduler.evaluated(time.time() - start)
+
     def set_fitness(self, population, start_set_fit): 
+        """
+            The residue model comes from residual_model, and the association search only runs for
+            (lag_residue, lag_sarimax, lag_estimated_residue, forecast_estimated_residue) not seen before,
+            see memo_search. The association is trained on the estimated residue, so its key also holds the
+            effort of the residue search it came from.
+        """
         for i in range(start_set_fit, len(population)):
+            start = self.prepare_inner_search(i, start_set_fit, len(population))
             #obter o erro estimado
-            erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida = self.train_test_split(
-                self._erro, population[i][0])
-            
-            #AG_erro
-            Ag_mlp_erro = Ag_mlp(erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida, self._num_epochs,
-                self._size_pop, self._prob_mut).search_best_individual()
-            best_erro = Ag_mlp_erro._best_of_all
-            
-            erro_estimado = np.concatenate([best_erro.predict(erro_train_entrada), best_erro.predict(erro_test_entrada)])
+            residual_effort, (best_erro, erro_estimado) = self.residual_model(population[i][0])
 
-            #obter o y estimado
-            X_ass_1_train_in, _, X_ass_1_test_in, _ = self.train_test_split(self._y_sarimax, population[i][1])
-            X_ass_2_train_in, _, X_ass_2_test_in, _ = self.train_test_split_prev(erro_estimado, population[i][2],
-                                                                                 population[i][3])
-
-            X_in_train = np.concatenate((X_ass_1_train_in, X_ass_2_train_in), axis=1)
-            X_in_test = np.concatenate((X_ass_1_test_in, X_ass_2_test_in), axis=1) 
-            
             #AG_ASS
-            Ag_MLP_ass = Ag_mlp(X_in_train, self._data_train, X_in_test, self._data_test, self._num_epochs,
-                                     self._size_pop, self._prob_mut).search_best_individual()
-            best_ass = Ag_MLP_ass._best_of_all   
-            
+            key = tuple(int(gene) for gene in population[i][:4]) + residual_effort
+            _, (best_ass, fitness) = self.memo_search(self._association_cache, key, 'association',
+                                                      self.association_model, population[i], erro_estimado)
             
             population[i][-3] = best_erro
-            population[i][-2] = best_ass
-            population[i][-1] = mae(best_ass.predict(X_in_test), self._data_test)
+            population[i][-2], population[i][-1] = best_ass, fitness
+            self.evaluated(start)
 
         return population
     
@@ -201,22 +311,118 @@ class AGMLP_Residual:
         
         return population
 
-    def search_best_model(self):
-        ng = 0
-        population = self.gen_population()
-        population = self.set_fitness(population, ng)
-        
-        population.sort(key = lambda x: x[:][-1])
-        self._fitness_array = np.append(self._fitness_array, population[0][-1])
-        self._best_of_all = population[0]
-        
-        for ng in tqdm(range(0, self._num_epochs)):
+    def save_checkpoint(self, checkpoint_path, population, generation):
+        """
+            Writes the search state after generation to checkpoint_path: the genomes and fitness of the population,
+            _fitness_array, the best individual with its models and the random and numpy RNG states.
+            The file is written to a temporary file first and then renamed, so a crash never leaves a broken checkpoint.
+        """
+        checkpoint = {'fingerprint': self._residual_fingerprint,
+                      'generation': generation,
+                      'genomes': [individual[:-3] for individual in population],
+                      'fitness': [individual[-1] for individual in population],
+                      'fitness_array': self._fitness_array,
+                      'best_of_all': self._best_of_all,
+                      'random_state': random.getstate(),
+                      'np_random_state': np.random.get_state()}
+
+        directory = os.path.dirname(os.path.abspath(checkpoint_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, checkpoint_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def load_checkpoint(self, checkpoint_path):
+        """
+            Restores the state saved by save_checkpoint. Returns the population and the last generation run.
+            Only the best individual keeps its models, the others get the 'objeto_erro' and 'objeto_ass'
+            placeholders, their fitness is known so they are not fitted again.
+        """
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+
+        if checkpoint['fingerprint'] != self._residual_fingerprint:
+            raise Exception("checkpoint was saved by a search with other data or settings")
+
+        self._fitness_array = checkpoint['fitness_array']
+        self._best_of_all = checkpoint['best_of_all']
+        random.setstate(checkpoint['random_state'])
+        np.random.set_state(checkpoint['np_random_state'])
+
+        population = []
+        for genome, fitness in zip(checkpoint['genomes'], checkpoint['fitness']):
+            if self._best_of_all is not None and list(genome) == list(self._best_of_all[:-3]):
+                population.append(list(self._best_of_all))
+            else:
+                population.append(list(genome) + ['objeto_erro', 'objeto_ass', fitness])
+
+        return population, checkpoint['generation']
+
+    def run_generations(self, population, first_gen, checkpoint_path=None, checkpoint_every=1):
+        for ng in tqdm(range(first_gen, self._num_epochs)):
             print('generation:', ng)
+            if self._scheduler is not None and self._scheduler.exhausted():
+                print('compute budget is over')
+                break
+
             population = self.new_gen(population, ng)
             if population[0][-1] < min(self._fitness_array):
                 self._best_of_all = population[0]
 
+            if checkpoint_path is not None and (ng + 1) % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path, population, ng)
+
             if self.early_stop():
                 break
-                
-        return self
\ No newline at end of file
+
+        if self._scheduler is not None:
+            self._budget_report = self._scheduler.report()
+            print('spend per level:', self._budget_report)
+
+        return self
+
+    def start_scheduler(self, first_gen):
+        if self._scheduler is not None:
+            planned = sum(self._size_pop - int(self._size_pop*g/(2*self._num_epochs))
+                          for g in range(first_gen, self._num_epochs))
+            if first_gen == 0:
+                planned += self._size_pop
+            self._scheduler.start(planned)
+
+    def search_best_model(self, checkpoint_path=None, checkpoint_every=1):
+        """
+            checkpoint_path - file where the search state is saved every checkpoint_every generations
+                (and after the first population), see resume. None for no checkpoints.
+        """
+        ng = 0
+        self.start_scheduler(ng)
+
+        with self.pool_scope():
+            self._ranked = False
+            population = self.gen_population()
+            population = self.set_fitness(population, ng)
+            
+            population.sort(key = lambda x: x[:][-1])
+            self._ranked = True
+            self._fitness_array = np.append(self._fitness_array, population[0][-1])
+            self._best_of_all = population[0]
+            if checkpoint_path is not None:
+                self.save_checkpoint(checkpoint_path, population, -1)
+
+            return self.run_generations(population, 0, checkpoint_path, checkpoint_every)
+
+    def resume(self, checkpoint_path, checkpoint_every=1):
+        """
+            Continues a search from the checkpoint saved by search_best_model(checkpoint_path) on an object
+            built with the same data and settings. Keeps saving to checkpoint_path.
+        """
+        population, generation = self.load_checkpoint(checkpoint_path)
+        self.start_scheduler(generation + 1)
+        self._ranked = True
+
+        with self.pool_scope():
+            return self.run_generations(population, generation + 1, checkpoint_path, checkpoint_every)
@@ -11,6 +11,11 @@ from tqdm import tqdm
 
 class AGMLP_VR_Residual(AGMLP_Residual):
     # TODO Documentar
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._residual_ensembles = {}
+        self._association_searches = {}
+
     def gen_population(self):
         """
             Generates the population. 
@@ -51,37 +56,90 @@ class AGMLP_VR_Residual(AGMLP_Residual):
 
         return population
     
+    def search_residual_ag(self, lag):
+        """
+            Ag_mlp search of the residue with lag past values, released (release_search_state) to be memoized.
+        """
+        erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida = self.train_test_split(self._erro, lag)
+        searched = Ag_mlp(erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida, self._inner_generations,
+                          self._inner_size_pop, self._prob_mut, executor=self._pool).search_best_individual()
+        self._n_fits += searched._n_fits
+
+        return searched.release_search_state()
+
+    def residual_search(self, lag):
+        """
+            Searched Ag_mlp of the residue with lag past values, memoized by memo_search. It runs once per lag
+            and is sliced into the voting ensembles of every percentage. Returns (effort, searched Ag_mlp).
+        """
+        return self.memo_search(self._residual_cache, self._residual_fingerprint + (int(lag),), 'residual',
+                                self.search_residual_ag, lag)
+
+    def residual_ensemble(self, lag, n_mlps):
+        """
+            Voting ensemble of the n_mlps best residue mlps and the residue it estimates for the whole serie.
+        """
+        residual_effort, searched = self.residual_search(lag)
+        key = (int(lag), n_mlps) + residual_effort
+        if key not in self._residual_ensembles:
+            erro_train_entrada, _, erro_test_entrada, _ = self.train_test_split(self._erro, lag)
+            VR_mlps_erro = searched.voting_ensemble(n_mlps)
+            erro_estimado = np.concatenate([VR_mlps_erro.VR_predict(erro_train_entrada), VR_mlps_erro.VR_predict(erro_test_entrada)])
+            self._residual_ensembles[key] = (VR_mlps_erro, erro_estimado)
+
+        return self._residual_ensembles[key]
+
+    def search_association_ag(self, individual, erro_estimado):
+        """
+            Ag_mlp search of the association of individual, released (release_search_state) to be memoized.
+            Returns it with the association test inputs.
+        """
+        X_in_train, X_in_test = self.association_inputs(individual, erro_estimado)
+        searched = Ag_mlp(X_in_train, self._data_train, X_in_test, self._data_test, self._inner_generations,
+                          self._inner_size_pop, self._prob_mut, executor=self._pool).search_best_individual()
+        self._n_fits += searched._n_fits
+
+        return searched.release_search_state(), X_in_test
+
+    def association_search(self, individual, n_mlps_erro, erro_estimado, residual_effort):
+        """
+            Searched Ag_mlp of the association, once per lags, size of the residue ensemble and effort of the
+            residue search, memoized by memo_search. Returns (effort, (searched Ag_mlp, association test inputs)).
+        """
+        key = tuple(int(gene) for gene in individual[:4]) + (n_mlps_erro,) + residual_effort
+
+        return self.memo_search(self._association_searches, key, 'association', self.search_association_ag,
+                                individual, erro_estimado)
+
     def set_fitness(self, population, start_set_fit): 
+        """
+            Every residue lag and association are searched once, a new 'percentage_of_mlps' only slices
+            the voting ensembles of searches already done, without training.
+        """
         print('start_set_fit:', start_set_fit)
         
         for i in range(start_set_fit, len(population)):
-            #obter o erro estimado
-            erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida = self.train_test_split(
-                self._erro, population[i][0])
-            
-            #AG_erro
+            start = self.prepare_inner_search(i, start_set_fit, len(population))
             percent_VR_heuristic = population[i][4]
-            
-            VR_mlps_erro = Ag_mlp(erro_train_entrada, erro_train_saida, erro_test_entrada, erro_test_saida, self._num_epochs,
-                                    self._size_pop, self._prob_mut).return_VotingRegressor(percent_VR_heuristic)
 
-            erro_estimado = np.concatenate([VR_mlps_erro.VR_predict(erro_train_entrada), VR_mlps_erro.VR_predict(erro_test_entrada)])
+            #AG_erro
+            residual_effort, searched_erro = self.residual_search(population[i][0])
+            n_mlps_erro = searched_erro.voting_size(percent_VR_heuristic)
+            VR_mlps_erro, erro_estimado = self.residual_ensemble(population[i][0], n_mlps_erro)
 
-            #obtain o y_hat. In thtat case only X data is needed from train_test_split and train_test_split_prev methods
-            X_ass_1_train_in, _, X_ass_1_test_in, _ = self.train_test_split(self._y_sarimax, population[i][1])
-            X_ass_2_train_in, _, X_ass_2_test_in, _ = self.train_test_split_prev(erro_estimado, population[i][2],
-                                                                                 population[i][3])
-            #concatanates the X data for training
-            X_in_train = np.concatenate((X_ass_1_train_in, X_ass_2_train_in), axis=1)
-            X_in_test = np.concatenate((X_ass_1_test_in, X_ass_2_test_in), axis=1) 
-            
             #AG_ASS
-            VR_mlps_ass = Ag_mlp(X_in_train, self._data_train, X_in_test, self._data_test, self._num_epochs,
-                                     self._size_pop, self._prob_mut).return_VotingRegressor(percent_VR_heuristic)
-            
+            association_effort, (searched_ass, X_in_test) = self.association_search(population[i], n_mlps_erro,
+                                                                                    erro_estimado, residual_effort)
+            n_mlps_ass = searched_ass.voting_size(percent_VR_heuristic)
+            key = (tuple(int(gene) for gene in population[i][:4]) + (n_mlps_erro, n_mlps_ass) + residual_effort
+                   + association_effort)
+            if key not in self._association_cache:
+                VR_mlps_ass = searched_ass.voting_ensemble(n_mlps_ass)
+                self._association_cache[key] = (VR_mlps_ass, mae(VR_mlps_ass.VR_predict(X_in_test), self._data_test))
+
             #save the models and MAE fitness 
             population[i][-3] = VR_mlps_erro
-            population[i][-2] = VR_mlps_ass
-            population[i][-1] = mae(VR_mlps_ass.VR_predict(X_in_test), self._data_test)
+            population[i][-2], population[i][-1] = self._association_cache[key]
+            self.evaluated(start)
 
         return population
@@ -5,6 +5,149 @@ import numpy as np
 import random
 from tqdm import tqdm
 from sklearn.ensemble import VotingRegressor
+from itertools import repeat
+from collections import OrderedDict
+import hashlib
+import math
+import copy
+from scipy.special import expit
+from mlopt.ParallelUtils import executor_scope, parallel_map
+
+def _fit_mlp(mlp, X_train, y_train, X_test, y_test):
+    """
+        Fits one individual of the population. It lives at module level so process pools can pickle it.
+        Returns the fitted mlp and its test MAE.
+    """
+    mlp.fit(X_train, y_train)
+    return mlp, mae(y_test, mlp.predict(X_test))
+
+def data_fingerprint(*arrays):
+    """
+        Returns a short hash of the arrays content and shapes, used to key caches by the data they were fitted on.
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+class FitnessCache:
+    """
+        Bounded (least recently used) map from (data fingerprint, training budget, genome) to (fitted mlp, MAE).
+        The same cache can be shared by many AgMlp searches, the fingerprint keeps their data apart and the
+        budget (max_iter, budget_mode, min_iter, eta) the models trained for a different number of iterations.
+
+        maxsize - maximum number of fitted models kept.
+    """
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._store = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key):
+        if key in self._store:
+            self._store.move_to_end(key)
+            self.hits += 1
+            return self._store[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._store[key] = value
+        self._store.move_to_end(key)
+        while len(self._store) > self._maxsize:
+            self._store.popitem(last=False)
+
+def _inplace_identity(x):
+    return x
+
+def _inplace_logistic(x):
+    return expit(x, out=x)
+
+def _inplace_tanh(x):
+    return np.tanh(x, out=x)
+
+def _inplace_relu(x):
+    return np.maximum(x, 0, out=x)
+
+ACTIVATIONS = {'identity': _inplace_identity, 'logistic': _inplace_logistic, 'tanh': _inplace_tanh,
+               'relu': _inplace_relu}
+
+class MLPEnsemble:
+    """
+        Averaging ensemble of fitted MLPRegressors compiled to stacked numpy arrays.
+        Members with the same layer shapes and activations are grouped and every group runs as one
+        batched matmul per layer, instead of one sklearn predict per member.
+        Members that are linear end to end (identity activations) are collapsed into a single summed linear map.
+
+        mlps - list of fitted MLPRegressor. Not fitted placeholders (strings) are ignored.
+        dtype - dtype of weights and inputs, np.float32 trades some precision for speed.
+    """
+    def __init__(self, mlps, dtype=np.float64):
+        self._dtype = dtype
+        self._n_members = 0
+        self._linear = None
+        self._groups = []
+        groups = {}
+        for mlp in filter(lambda x: type(x) is not str, mlps):
+            self._n_members += 1
+            if mlp.activation == 'identity' and mlp.out_activation_ == 'identity':
+                coef, intercept = mlp.coefs_[0], mlp.intercepts_[0]
+                for l in range(1, len(mlp.coefs_)):
+                    coef = coef @ mlp.coefs_[l]
+                    intercept = intercept @ mlp.coefs_[l] + mlp.intercepts_[l]
+                if self._linear is None:
+                    self._linear = [coef, intercept]
+                else:
+                    self._linear = [self._linear[0] + coef, self._linear[1] + intercept]
+            else:
+                key = (tuple(c.shape for c in mlp.coefs_), mlp.activation, mlp.out_activation_)
+                groups.setdefault(key, []).append(mlp)
+
+        if self._linear is not None:
+            self._linear = [self._linear[0].astype(dtype), self._linear[1].astype(dtype)]
+
+        for (shapes, activation, out_activation), members in groups.items():
+            # the first layer of the whole group is a single (features x members*units) matrix
+            first_coef = np.concatenate([m.coefs_[0] for m in members], axis=1).astype(dtype)
+            first_intercept = np.concatenate([m.intercepts_[0] for m in members]).astype(dtype)
+            coefs = [np.stack([m.coefs_[l] for m in members]).astype(dtype) for l in range(1, len(shapes))]
+            intercepts = [np.stack([m.intercepts_[l] for m in members])[:, np.newaxis, :].astype(dtype)
+                          for l in range(1, len(shapes))]
+            self._groups.append((len(members), first_coef, first_intercept, coefs, intercepts,
+                                 ACTIVATIONS[activation], ACTIVATIONS[out_activation]))
+
+    def predict(self, X):
+        """
+            Returns the average of the members predictions, the same as averaging their predict outputs.
+        """
+        X = np.asarray(X, dtype=self._dtype)
+        summed = 0
+        if self._linear is not None:
+            summed = X @ self._linear[0] + self._linear[1]
+
+        for n_members, first_coef, first_intercept, coefs, intercepts, activation, out_activation in self._groups:
+            output = X @ first_coef
+            output += first_intercept
+            output = output.reshape(X.shape[0], n_members, -1).transpose(1, 0, 2)
+            for layer in range(len(coefs)):
+                output = activation(output)
+                output = np.matmul(output, coefs[layer])
+                output += intercepts[layer]
+            summed = summed + out_activation(output).sum(axis=0)
+
+        averaged_output = summed/self._n_members
+        if averaged_output.shape[1] == 1:
+            return averaged_output.ravel()
+
+        return averaged_output
 
 class AgMlp:
     """
@@ -12,7 +155,28 @@ class AgMlp:
         and to use specifics parameters that depends on the solver and learning_rate:
         https://scikit-learn.org/stable/modules/generated/sklearn.neural_network.MLPRegressor.html
     """
-    def __init__(self,X_train, y_train, X_test, y_test, num_generations, size_population, prob_mut, alpha_stop=1e-4):
+    def __init__(self,X_train, y_train, X_test, y_test, num_generations, size_population, prob_mut, alpha_stop=1e-4,
+                 executor='serial', n_jobs=None, fitness_cache=True, max_iter=500, budget_mode=None, min_iter=25, eta=3,
+                 ensemble_dtype=np.float64, inherit_weights=False):
+        """
+            executor - how the individuals of a generation are fitted: 'serial', 'thread', 'process'
+                or an already created concurrent.futures.Executor, which is shared and not shut down.
+            n_jobs - number of workers for 'thread' and 'process'. None uses all the cpus.
+            fitness_cache - True keeps a FitnessCache for this search, so individuals with an already known genome
+                are not refitted. A FitnessCache object can be passed to share it between searches. False disables it.
+            max_iter - training iterations of every mlp.
+            budget_mode - None trains every individual for max_iter. 'successive_halving' trains all of them for min_iter,
+                then only the best 1/eta of each level keeps training (warm start) for eta times more iterations, until max_iter.
+            min_iter - iterations of the first level of 'successive_halving'.
+            eta - reduction factor between the levels of 'successive_halving'.
+            ensemble_dtype - dtype used by the compiled voting ensemble of VR_predict, np.float32 is faster.
+            inherit_weights - if True, an individual whose layers only grew after mutation (same solver and activation)
+                starts training from the weights of the mlp it carried, new units get small random weights.
+                The estimated iterations saved on every generation are kept in _saved_iterations.
+        """
+        if budget_mode not in [None, 'successive_halving']:
+            raise Exception("budget_mode - choose between None and 'successive_halving'")
+
         self._X_train = X_train
         self._y_train = y_train
         self._X_test = X_test
@@ -25,7 +189,48 @@ class AgMlp:
         self._best_of_all = None
         self._final_trained_mlps = None
         self._n_voting_mlps = None
+        self._executor = executor
+        self._n_jobs = n_jobs
+        self._pool = None
+        if fitness_cache is True:
+            fitness_cache = FitnessCache()
+        elif fitness_cache is False:
+            fitness_cache = None
+        self._fitness_cache = fitness_cache
+        self._data_fingerprint = data_fingerprint(X_train, y_train, X_test, y_test)
+        self._max_iter = max_iter
+        self._budget_mode = budget_mode
+        self._min_iter = min_iter
+        self._eta = eta
+        self._ensemble_dtype = ensemble_dtype
+        self._ensemble = None
+        self._inherit_weights = inherit_weights
+        self._saved_iterations = []
+        self._cold_iterations = []
+        self._n_fits = 0
     
+    def __getstate__(self):
+        """
+            Pickled state without the fitness cache, the executor pool and the compiled ensemble.
+            A voting ensemble only keeps its voting mlps, so checkpoints do not grow with the search.
+        """
+        state = self.__dict__.copy()
+        state['_fitness_cache'] = None
+        state['_pool'] = None
+        state['_ensemble'] = None
+        if self._n_voting_mlps is not None:
+            state['_final_trained_mlps'] = list(self._n_voting_mlps)
+
+        return state
+
+    def genome_key(self, individual):
+        """
+            Cache key of an individual: data fingerprint, training budget (max_iter, budget_mode, min_iter, eta)
+            plus (solver, layer sizes, activation, learning_rate).
+        """
+        return (self._data_fingerprint, self._max_iter, self._budget_mode, self._min_iter, self._eta, individual[0], int(individual[1]), int(individual[2]), int(individual[3]),
+                individual[4], individual[5])
+
     def gen_population(self):
         """
             Generates the population, which is a list of lists.
@@ -44,21 +249,176 @@ class AgMlp:
         return population
 
     def set_fitness_and_sort(self, population, start_set_fit):
-        for i in range(start_set_fit, len(population)):
-            mlp_volatil = MLPRegressor(hidden_layer_sizes=(population[i][1], population[i][2], population[i][3]),
-                                    activation = population[i][4], solver = population[i][0],
-                                    learning_rate = population[i][5], max_iter = 500, early_stopping=True)
-            #qt_fits=0
-            mlp_volatil.fit(self._X_train, self._y_train)
-            mae_fits= mae(self._y_test, mlp_volatil.predict(self._X_test))
-
-            population[i][-1] = mae_fits
-            population[i][-2] = mlp_volatil
+        """
+            Fits the individuals from start_set_fit onward, at the same time if an executor pool is running.
+            Genomes already in the fitness cache, or repeated inside the population, are fitted only once.
+            The random_state of every mlp is drawn here in population order, so any executor gives the
+            same result as a serial run with the same seed.
+        """
+        if self._fitness_cache is not None:
+            keys = [self.genome_key(population[i]) for i in range(start_set_fit, len(population))]
+        else:
+            keys = list(range(start_set_fit, len(population)))
+        seeds = [np.random.randint(0, 2**31 - 1) for _ in keys]
+
+        results = {}
+        mlps = {}
+        inherited = set()
+        for i, key, seed in zip(range(start_set_fit, len(population)), keys, seeds):
+            if key in results or key in mlps:
+                continue
+            cached = self._fitness_cache.get(key) if self._fitness_cache is not None else None
+            if cached is not None:
+                results[key] = cached
+            elif self._inherit_weights and self.can_inherit(population[i][-2], population[i]):
+                mlps[key] = self.inherit_mlp(population[i][-2], population[i], seed)
+                inherited.add(key)
+            else:
+                mlps[key] = MLPRegressor(hidden_layer_sizes=(population[i][1], population[i][2], population[i][3]),
+                                        activation = population[i][4], solver = population[i][0],
+                                        learning_rate = population[i][5], max_iter = self._max_iter, early_stopping=True,
+                                        random_state = seed)
+
+        if self._budget_mode == 'successive_halving':
+            fitted = self.successive_halving(list(mlps.values()))
+        else:
+            fitted = self.fit_mlps(list(mlps.values()))
+
+        for key, mlp_and_mae in zip(mlps.keys(), fitted):
+            results[key] = mlp_and_mae
+            if self._fitness_cache is not None:
+                self._fitness_cache.put(key, mlp_and_mae)
+
+        if self._inherit_weights:
+            self.count_saved_iterations(results, mlps.keys(), inherited)
+
+        for i, key in zip(range(start_set_fit, len(population)), keys):
+            population[i][-2], population[i][-1] = results[key]
         
-        population.sort(key = lambda x: x[:][-1])
+        # max_iter is the training budget the mlp got, so only individuals trained with the same budget are compared by MAE
+        population.sort(key = lambda x: (-getattr(x[-2], 'max_iter', 0), x[-1]))
         
         return population
 
+    def can_inherit(self, parent, individual):
+        """
+            True if the fitted mlp carried by individual has the same solver and activation
+            and no hidden layer bigger than the genome asks for.
+        """
+        if not isinstance(parent, MLPRegressor) or not hasattr(parent, 'coefs_'):
+            return False
+
+        parent_sizes = [c.shape[1] for c in parent.coefs_[:-1]]
+        return (parent.solver == individual[0] and parent.activation == individual[4]
+                and parent.coefs_[0].shape[0] == np.shape(self._X_train)[1] and len(parent_sizes) == 3
+                and all(p <= c for p, c in zip(parent_sizes, individual[1:4])))
+
+    def inherit_mlp(self, parent, individual, seed, scale=1e-2):
+        """
+            Returns a warm start mlp for individual with the trained weights of parent copied in place.
+            Weights of the new units are drawn uniformly from [-scale, scale].
+        """
+        rng = np.random.RandomState(seed)
+        sizes = (int(individual[1]), int(individual[2]), int(individual[3]))
+        child = copy.deepcopy(parent)
+        child.set_params(hidden_layer_sizes = sizes, learning_rate = individual[5], max_iter = self._max_iter,
+                         random_state = seed, warm_start = True)
+
+        units = [parent.coefs_[0].shape[0]] + list(sizes) + [parent.coefs_[-1].shape[1]]
+        for l in range(len(units) - 1):
+            coef = rng.uniform(-scale, scale, (units[l], units[l+1]))
+            intercept = rng.uniform(-scale, scale, units[l+1])
+            rows, cols = parent.coefs_[l].shape
+            coef[:rows, :cols] = parent.coefs_[l]
+            intercept[:cols] = parent.intercepts_[l]
+            child.coefs_[l] = coef.astype(parent.coefs_[l].dtype)
+            child.intercepts_[l] = intercept.astype(parent.intercepts_[l].dtype)
+
+        # resets the training state the parent left, as a first fit would do
+        child._best_coefs = [c.copy() for c in child.coefs_]
+        child._best_intercepts = [i.copy() for i in child.intercepts_]
+        child.n_iter_ = 0
+        child.t_ = 0
+        if child.solver != 'lbfgs':
+            child.loss_curve_ = []
+            child._no_improvement_count = 0
+            child.validation_scores_ = []
+            child.best_validation_score_ = -np.inf
+            child.best_loss_ = None
+
+        return child
+
+    def count_saved_iterations(self, results, fitted_keys, inherited):
+        """
+            Appends to _saved_iterations the iterations the inherited mlps of this generation saved,
+            estimated against the mean iterations of all the mlps trained from random init so far.
+        """
+        saved = 0
+        for key in fitted_keys:
+            mlp = results[key][0]
+            mlp.set_params(warm_start = False)
+            if key not in inherited:
+                self._cold_iterations.append(mlp.n_iter_)
+
+        if len(self._cold_iterations) > 0:
+            mean_cold = np.mean(self._cold_iterations)
+            for key in inherited:
+                saved += max(0, mean_cold - results[key][0].n_iter_)
+
+        self._saved_iterations.append(int(saved))
+
+    def fit_mlps(self, mlps):
+        """
+            Fits the mlps on the executor pool. Returns a list of (fitted mlp, MAE) in the same order.
+        """
+        self._n_fits += len(mlps)
+        return parallel_map(_fit_mlp, mlps, repeat(self._X_train), repeat(self._y_train), repeat(self._X_test),
+                            repeat(self._y_test), executor=self._pool)
+
+    def budget_levels(self):
+        """
+            Total training iterations of each successive halving level: min_iter, min_iter*eta, ..., max_iter.
+        """
+        levels = []
+        budget = self._min_iter
+        while budget < self._max_iter:
+            levels.append(budget)
+            budget = budget*self._eta
+        levels.append(self._max_iter)
+
+        return levels
+
+    def successive_halving(self, mlps):
+        """
+            Trains all mlps for the first budget level, keeps the best 1/eta of them and resumes their training
+            (warm start) up to the next level, until max_iter. MAEs are only compared inside a level.
+            The max_iter of each returned mlp is set to the total iterations it was given, which ranks
+            the individuals of higher levels first when the population is sorted.
+            Returns a list of (fitted mlp, MAE) in the same order of mlps.
+        """
+        results = [None]*len(mlps)
+        alive = list(range(len(mlps)))
+        levels = self.budget_levels()
+        trained = 0
+
+        for level, budget in enumerate(levels):
+            for k in alive:
+                mlps[k].set_params(max_iter = budget - trained, warm_start = True)
+
+            fitted = self.fit_mlps([mlps[k] for k in alive])
+            for k, (mlp, mae_fit) in zip(alive, fitted):
+                mlps[k] = mlp
+                results[k] = (mlp, mae_fit)
+
+            for k in alive:
+                mlps[k].set_params(max_iter = budget, warm_start = False)
+
+            trained = budget
+            if level < len(levels) - 1:
+                alive = sorted(alive, key=lambda k: results[k][1])[:max(1, math.ceil(len(alive)/self._eta))]
+
+        return results
+
     def cruzamento(self, population):
         qt_cross = len(population[0])
         pop_ori = population
@@ -97,39 +457,90 @@ class AgMlp:
         return to_break
     
     def search_best_individual(self):
-        population = self.gen_population()
-        population = self.set_fitness_and_sort(population, 0)
-
-        self._fitness_array= np.append(self._fitness_array, population[0][-1])
-        self._best_of_all = population[0][-2]
+        with executor_scope(self._executor, self._n_jobs) as pool:
+            self._pool = pool
+            try:
+                population = self.gen_population()
+                population = self.set_fitness_and_sort(population, 0)
 
-        for ng in tqdm(range(0, self._num_generations)):
-            population = self.new_gen(population, ng)
-            
-            if population[0][-1] < min(self._fitness_array):
+                self._fitness_array= np.append(self._fitness_array, population[0][-1])
                 self._best_of_all = population[0][-2]
-                
-            if self.early_stop():
-                break
+
+                for ng in tqdm(range(0, self._num_generations)):
+                    population = self.new_gen(population, ng)
+                    
+                    if population[0][-1] < min(self._fitness_array):
+                        self._best_of_all = population[0][-2]
+                        
+                    if self.early_stop():
+                        break
+            finally:
+                self._pool = None
 
         self._final_trained_mlps = [p[-2] for p in population]
         
         return self
 
-    def return_VotingRegressor(self, percent):
+    def voting_size(self, percent):
         """
-            returns fited voting regressor objetc percent of bests mlps trained
+            Number of mlps in the voting ensemble of percent of the trained mlps, at least one.
         """
-        self.search_best_individual()
+        if self._final_trained_mlps is None:
+            raise Exception("search_best_individual must run before the voting ensemble is taken")
+
         Number = int(len(self._final_trained_mlps)*percent/100)
         if Number < 1:
             Number = 1
-        self._n_voting_mlps = self._final_trained_mlps[:Number]
+
+        return Number
+
+    def voting_ensemble(self, n_mlps):
+        """
+            Returns a copy of this searched AgMlp voting with its n_mlps best trained mlps, without any new training.
+            The copy shares the trained mlps and data with this object, so one search can be sliced into many ensembles.
+        """
+        if self._final_trained_mlps is None:
+            raise Exception("search_best_individual must run before the voting ensemble is taken")
+
+        voting = object.__new__(type(self))
+        voting.__dict__.update(self.__dict__)
+        voting._n_voting_mlps = self._final_trained_mlps[:n_mlps]
+        voting._ensemble = None
+
+        return voting
+
+    def release_search_state(self):
+        """
+            Drops what only the search needs: the fitness cache, the executor pool and the train and test data.
+            The sorted trained mlps and the fitness array are kept, so voting_size, voting_ensemble and VR_predict
+            still work, but the search cannot run again. Returns self, to keep a finished search in a memo.
+        """
+        if self._final_trained_mlps is None:
+            raise Exception("search_best_individual must run before the search state is released")
+
+        self._fitness_cache = None
+        self._pool = None
+        self._X_train, self._y_train, self._X_test, self._y_test = None, None, None, None
+
+        return self
+
+    def return_VotingRegressor(self, percent):
+        """
+            returns fited voting regressor objetc percent of bests mlps trained
+            The search only runs the first time, later calls reuse the trained mlps.
+        """
+        if self._final_trained_mlps is None:
+            self.search_best_individual()
+        self._n_voting_mlps = self._final_trained_mlps[:self.voting_size(percent)]
+        self._ensemble = MLPEnsemble(self._n_voting_mlps, self._ensemble_dtype)
         
         return self
 
     def VR_predict(self, Xin):
-        filtered = list(filter(lambda x: type(x) is not str, self._n_voting_mlps))
-        averaged_output = np.average(list(map(lambda x: x.predict(Xin), filtered)), axis=0)
+        """
+            Averaged output of the voting mlps, computed by the compiled MLPEnsemble.
+        """
+        if self._ensemble is None:
+            self._ensemble = MLPEnsemble(self._n_voting_mlps, self._ensemble_dtype)
         
-        return averaged_output
\ No newline at end of file
+        return self._ensemble.predict(Xin)
\ No newline at end of file
@@ -9,14 +9,34 @@ from sklearn.linear_model import RANSACRegressor as RAN
 from sklearn.linear_model import PassiveAggressiveRegressor as PAR
 from sklearn.linear_model import SGDRegressor as SGD
 from sklearn.ensemble import VotingRegressor
+from sklearn.base import clone
+from sklearn.utils import Bunch
+from mlopt.ParallelUtils import executor_scope, parallel_map
+from itertools import repeat
 import numpy as np
 import random
 from tqdm import tqdm
 
+def _fit_member(regressor, X_train, y_train, X_test, y_test):
+    """
+        Fits a copy of regressor. Returns the fitted regressor, its test predictions and its MAE.
+    """
+    regressor = clone(regressor).fit(X_train, np.ravel(y_train))
+    predictions = regressor.predict(X_test)
+
+    return regressor, predictions, mae(predictions, y_test)
+
 class EnsembleSearch:
     
-    def __init__(self, X_train, y_train, X_test, y_test, epochs=3, size_pop=40, prob_mut=0.8, alpha_stop=1e-4, verbose=True):
-        
+    def __init__(self, X_train, y_train, X_test, y_test, epochs=3, size_pop=40, prob_mut=0.8, alpha_stop=1e-4, verbose=True,
+                 executor='serial', n_jobs=None):
+        """
+            executor - how the members of a generation are fitted: 'serial', 'thread', 'process'
+                or an already created concurrent.futures.Executor, which is shared and not shut down.
+                The members missing from the prediction library of all the individuals are fitted together,
+                each with one BLAS/OpenMP thread and n_jobs=1, so the pool is the only source of parallelism.
+            n_jobs - number of workers for 'thread' and 'process'. None uses all the cpus.
+        """
         self._X_train = X_train
         self._y_train = y_train
         self._X_test = X_test
@@ -28,6 +48,11 @@ class EnsembleSearch:
         self._verbose = verbose
         self._alpha_stop = alpha_stop
         self._prob_mut = prob_mut
+        self._n_fits = 0
+        self._library = {}
+        self._executor = executor
+        self._n_jobs = n_jobs
+        self._pool = None
 
     def gen_population(self):
 
@@ -86,29 +111,85 @@ class EnsembleSearch:
             
         return population
 
+    def member_key(self, member):
+        """
+            Configuration of a [name, regressor, params, fitness] member: its name without the 'X' added to
+            repeated names and its params. Crossover copies members, so the same key shows up in many individuals.
+        """
+        return (member[0].rstrip('X'),) + tuple(sorted((param, repr(value)) for param, value in member[2].items()))
+
+    def fit_members(self, population):
+        """
+            Fits the member configurations of the population that are not in the prediction library yet,
+            all at once on the executor pool. Each fitted regressor, its test predictions and its MAE are kept
+            for every later individual with the same member.
+        """
+        missing = {}
+        for individual in population:
+            for member in individual[1]:
+                key = self.member_key(member)
+                if key not in self._library and key not in missing:
+                    missing[key] = member[1]
+
+        # the random_state of unseeded members is drawn here in population order, so any executor gives the
+        # same result as a serial run with the same seed
+        regressors = []
+        for regressor in missing.values():
+            params = regressor.get_params()
+            settings = {}
+            if 'random_state' in params and params['random_state'] is None:
+                settings['random_state'] = np.random.randint(0, 2**31 - 1)
+            if self._pool is not None and 'n_jobs' in params:
+                settings['n_jobs'] = 1
+            regressors.append(clone(regressor).set_params(**settings))
+
+        # regressors without random_state (SVR) draw their seed from the global np.random, of this process on
+        # serial and thread runs but of the workers on process runs, so its state is put back after the fits
+        np_random_state = np.random.get_state()
+        try:
+            results = parallel_map(_fit_member, regressors, repeat(self._X_train), repeat(self._y_train),
+                                   repeat(self._X_test), repeat(self._y_test), executor=self._pool)
+        finally:
+            np.random.set_state(np_random_state)
+        self._library.update(zip(missing, results))
+        self._n_fits += len(results)
+
+    def voting_regressor(self, names, regressors):
+        """
+            Fitted VotingRegressor made of regressors that are already fitted, without fitting them again.
+        """
+        Voting_regressor = VotingRegressor(list(zip(names, regressors)))
+        Voting_regressor.estimators_ = list(regressors)
+        Voting_regressor.named_estimators_ = Bunch(**dict(zip(names, regressors)))
+
+        return Voting_regressor
+
     def set_fitness(self, population):
-        # must evaluated each regressor individually also and sort inside the individual
-        # then make a better crossover.
+        """
+            Every member configuration is fitted once (fit_members), the fitness of an individual is the MAE of
+            the mean of its members test predictions, the same as its VotingRegressor predict.
+        """
+        self.fit_members(population)
         for i in range(len(population)):
             
-            lista_tuplas_VR = []
             nomes = []
+            regressors = []
+            predictions = []
             for indv in population[i][1]:
                 # adds X if name already used
                 while indv[0] in nomes:
                     indv[0] = indv[0]+'X'
                 nomes.append(indv[0])
-                #make the tuples for VR: (name, regressor)
-                lista_tuplas_VR.append((indv[0],indv[1]))
 
-            Voting_regressor = VotingRegressor(lista_tuplas_VR)
-            Voting_regressor.fit(self._X_train, self._y_train)
-            
-            mae_vr = mae(Voting_regressor.predict(self._X_test), self._y_test)
+                regressor, member_predictions, indv[3] = self._library[self.member_key(indv)]
+                regressors.append(regressor)
+                predictions.append(member_predictions)
+
+            mae_vr = mae(np.mean(predictions, axis=0), self._y_test)
             # sets fitness 
             population[i][-1] = mae_vr
             # sets the object
-            population[i][-2] = Voting_regressor
+            population[i][-2] = self.voting_regressor(nomes, regressors)
             
         return population
     
@@ -152,25 +233,30 @@ class EnsembleSearch:
         return to_break
 
     def search_best(self):
-        population = self.gen_population()
-        population = self.set_fitness(population)
-        population.sort(key = lambda x: x[-1])  
-        self._fitness_array = np.append(self._fitness_array, population[0][-1])
-        self._best_of_all = population[0][-2]
-        
-        for i in tqdm(range(self._epochs)):
-            population = self.next_population(population)
-            population = self.set_fitness(population)
-            population.sort(key = lambda x: x[-1])
-            
-            #pegar o melhor de todas as épocas
-            if population[0][-1] < min(self._fitness_array):
+        with executor_scope(self._executor, self._n_jobs, inner_threads=1) as pool:
+            self._pool = pool
+            try:
+                population = self.gen_population()
+                population = self.set_fitness(population)
+                population.sort(key = lambda x: x[-1])  
+                self._fitness_array = np.append(self._fitness_array, population[0][-1])
                 self._best_of_all = population[0][-2]
-            
-            #adicionar ao array de fitness o atual
-            self._fitness_array = np.append(self._fitness_array, population[0][-1])
+                
+                for i in tqdm(range(self._epochs)):
+                    population = self.next_population(population)
+                    population = self.set_fitness(population)
+                    population.sort(key = lambda x: x[-1])
+                    
+                    #pegar o melhor de todas as épocas
+                    if population[0][-1] < min(self._fitness_array):
+                        self._best_of_all = population[0][-2]
+                    
+                    #adicionar ao array de fitness o atual
+                    self._fitness_array = np.append(self._fitness_array, population[0][-1])
 
-            if self.early_stop():
-                break
+                    if self.early_stop():
+                        break
+            finally:
+                self._pool = None
             
         return self
\ No newline at end of file
@@ -1,85 +1,130 @@
 import numpy as np
-from numpy.random import choice
-import random
 from tqdm import tqdm
-import numpy as np
+from itertools import repeat
+from mlopt.ParallelUtils import executor_scope, parallel_map
 import sys
 
-class Weed:
-    def __init__(self, dim, minx, maxx, function, functionArgs=[]):
-        self.Position = np.random.rand(dim)
+class IWO:
+    def __init__(self, dim, minx, maxx, function, functionArgs=[], batchFunction=None, executor='serial', n_jobs=None,
+                 chunksize=1):
+        """
+        dim - dimention of the problem, space of search
+        minx - bottom boundary for the space of search
+        maxx - topper boundary for the space of search
+        function - cost function, cost = function(position, functionArgs), the smaller the better
+        functionArgs - Extra arguments for the cost function
+        batchFunction - optional, cost of many weeds at once, used instead of function. Must be like
+            costs = batchFunction(positions, functionArgs)
+            where positions is a (number_of_weeds x dim) array and costs has number_of_weeds floats.
+        executor - how the seeds of an iteration are evaluated with function: 'serial', 'thread', 'process'
+            or an already created concurrent.futures.Executor, which is shared and not shut down.
+            Seeds are drawn on the main process only, so any executor gives the same result for a given np.random seed.
+        n_jobs - number of workers for 'thread' and 'process'. None uses all the cpus.
+        chunksize - number of seeds sent to a worker at a time, bigger chunks suit cheap cost functions on 'process'.
+
+        The population is kept as a (number_of_weeds x dim) array of positions and an array of costs,
+        sorted from the best weed.
+        """
         self.dim = dim
         self.minx = minx
         self.maxx = maxx
         self.CostFunction = function
-        self.CostFunctionParameters = functionArgs=[]
-        self.Cost=None
-        self.calc_Cost()
-
-    def calc_Cost(self):
-        self.Cost = self.CostFunction(self.Position, self.CostFunctionParameters)
-
-    def update_position(self, Position):
-        self.Position = np.clip(Position, a_min=self.minx, a_max=self.maxx)
-        self.calc_Cost()
-
-class IWO(Weed):
-    def __init__(self, dim, minx, maxx, function, functionArgs=[]):
-        super(IWO, self).__init__(dim, minx, maxx, function, functionArgs=[])
+        self.CostFunctionParameters = functionArgs
+        self.batchFunction = batchFunction
+        self.Positions = None
+        self.Costs = None
         self.historic_best_pos = []
         self.historic_best_error = []
+        self.best_iwo_pos = None
         self.best_iwo_cost = sys.float_info.max
-    
-    def Reproduction(self, population, Sigma, minCost, maxCost, Smin=0, Smax=5):
-        # Initialize Offsprings Population
-        newpop = []
-
-        for i in range(len(population)):
-            ratio = (population[i].Cost - minCost)/(maxCost - minCost)
-            S = int(np.floor(Smin + (Smax - Smin)*ratio))
-            
-            for j in range(S):
-                # Initialize Offspring
-                newsol = Weed(self.dim, self.minx, self.maxx, self.CostFunction, self.CostFunctionParameters)
-                
-                # Generate Random Location
-                newsol.update_position(population[i].Position + Sigma * np.random.randn(self.dim))
-                
-                # Add Offpsring to the Population
-                newpop.append(newsol)
-
-        return newpop
-
-    def MergePopulation(self, population, newpopulation, weed_qtz):
-        appended_pop = population + newpopulation
-        sorted_pop = sorted(appended_pop, key=lambda x: x.Cost, reverse=False)
-        return sorted_pop[:weed_qtz]
-    
+        self.n_evaluations = 0
+        self._executor = executor
+        self._n_jobs = n_jobs
+        self._chunksize = chunksize
+        self._pool = None
+
+    def calc_Costs(self, Positions):
+        """
+            Costs of every row of Positions, each evaluated once, at the same time if an executor pool is running.
+        """
+        self.n_evaluations += len(Positions)
+        if len(Positions) == 0:
+            return np.zeros(0)
+        elif self.batchFunction is not None:
+            return np.asarray(self.batchFunction(Positions, self.CostFunctionParameters), dtype=float).reshape(-1)
+
+        return np.array(parallel_map(self.CostFunction, Positions, repeat(self.CostFunctionParameters),
+                                     executor=self._pool, chunksize=self._chunksize), dtype=float)
+
+    def Reproduction(self, Positions, Costs, Sigma, Smin=0, Smax=5):
+        """
+            Seeds of every weed of the population, from Smin for the lowest cost to Smax for the highest,
+            spread around their parent with standard deviation Sigma and clipped to [minx, maxx].
+            Returns the positions and costs of all the seeds.
+        """
+        minCost, maxCost = Costs.min(), Costs.max()
+        if maxCost > minCost:
+            ratio = (Costs - minCost)/(maxCost - minCost)
+        else:
+            # all the weeds cost the same, all of them spread Smax seeds
+            ratio = np.ones(len(Costs))
+        S = np.floor(Smin + (Smax - Smin)*ratio).astype(int)
+
+        # Generate Random Locations of all the Offsprings
+        parents = np.repeat(np.arange(len(Costs)), S)
+        newPositions = np.clip(Positions[parents] + Sigma * np.random.randn(len(parents), self.dim), self.minx, self.maxx)
+
+        return newPositions, self.calc_Costs(newPositions)
+
+    def MergePopulation(self, Positions, Costs, newPositions, newCosts, weed_qtz):
+        """
+            Keeps the weed_qtz lowest costs of both populations, sorted. Ties keep the population order.
+        """
+        appended_pos = np.concatenate([Positions, newPositions])
+        appended_costs = np.concatenate([Costs, newCosts])
+        if weed_qtz < len(appended_costs):
+            kept = np.argpartition(appended_costs, weed_qtz - 1)[:weed_qtz]
+        else:
+            kept = np.arange(len(appended_costs))
+        kept = kept[np.lexsort((kept, appended_costs[kept]))]
+
+        return appended_pos[kept], appended_costs[kept]
+
     def search(self, weed_qtz_i=10, weed_qtz_f=100, MaxIt=200, print_at_every = 10, Smin=0, Smax=5, Exponent = 2, sigma_initial = 0.5, sigma_final = 0.001):
         plot_follow = print_at_every
-        population = [Weed(self.dim, self.minx, self.maxx, self.CostFunction, self.CostFunctionParameters) for _ in range(weed_qtz_i)]
-        weed_qtz = weed_qtz_i
-        
-        for it in tqdm(range(MaxIt)):
-            
-            # Update Standard Deviation
-            Sigma = ((MaxIt - it)/(MaxIt - 1))**Exponent * (sigma_initial - sigma_final) + sigma_final
-            
-            # Get Best and Worst Cost Values
-            Costs = [pop.Cost for pop in population]            
-            newpopulation = self.Reproduction(population, Sigma, min(Costs), max(Costs), Smin, Smax)
-            population = self.MergePopulation(population, newpopulation, weed_qtz)
-            
-            # increase max population size
-            weed_qtz += int((weed_qtz_f - weed_qtz)*it/MaxIt)
-            
-            self.historic_best_pos.append(population[0].Position)
-            self.historic_best_error.append(population[0].Cost)
-
-            if it >= plot_follow:
-                plot_follow += print_at_every
-                # mostrando a melhor rota a cada iteracao
-                print("######## iteracao {0} ##########".format(it))
-                print("Best Point {0}, Best Cost: {1}, Sigma: {2}, Weeds: {3}".format(population[0].Position, population[0].Cost, Sigma, len(population)))
-
-        return self
\ No newline at end of file
+        with executor_scope(self._executor, self._n_jobs) as pool:
+            self._pool = pool
+            try:
+                Positions = np.random.rand(weed_qtz_i, self.dim)
+                Costs = self.calc_Costs(Positions)
+                weed_qtz = weed_qtz_i
+
+                for it in tqdm(range(MaxIt)):
+
+                    # Update Standard Deviation
+                    Sigma = ((MaxIt - it)/(MaxIt - 1))**Exponent * (sigma_initial - sigma_final) + sigma_final
+
+                    newPositions, newCosts = self.Reproduction(Positions, Costs, Sigma, Smin, Smax)
+                    Positions, Costs = self.MergePopulation(Positions, Costs, newPositions, newCosts, weed_qtz)
+
+                    # increase max population size
+                    weed_qtz += int((weed_qtz_f - weed_qtz)*it/MaxIt)
+
+                    self.historic_best_pos.append(Positions[0])
+                    self.historic_best_error.append(Costs[0])
+                    if Costs[0] < self.best_iwo_cost:
+                        self.best_iwo_cost = Costs[0]
+                        self.best_iwo_pos = Positions[0]
+
+                    if it >= plot_follow:
+                        plot_follow += print_at_every
+                        # mostrando a melhor rota a cada iteracao
+                        print("######## iteracao {0} ##########".format(it))
+                        print("Best Point {0}, Best Cost: {1}, Sigma: {2}, Weeds: {3}".format(Positions[0], Costs[0], Sigma, len(Positions)))
+            finally:
+                self._pool = None
+
+        self.Positions = Positions
+        self.Costs = Costs
+
+        return self
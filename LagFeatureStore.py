@@ -0,0 +1,118 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from collections import OrderedDict
+
+def _lag_windows(values, max_lags_pass, max_lags_fut):
+    """
+        Strided (no copy) view where row i is serie[i-max_lags_pass:i+max_lags_fut], zero padded at both ends.
+    """
+    padded = np.concatenate([np.zeros(max_lags_pass), values, np.zeros(max_lags_fut)])
+    return sliding_window_view(padded, max_lags_pass + max_lags_fut)[:len(values)]
+
+def _fill_lag_matrix(windows, values, max_lags_pass, num_lags_pass, num_lags_fut):
+    """
+        Builds X and y from the window view with a single vectorized copy, with the same rows the old loop wrote:
+            row i is zero while i <= num_lags_pass,
+            X[i,:] = serie[i-num_lags_pass:i+num_lags_fut] while i+num_lags_fut <= len(serie),
+            X[i,-num_lags_pass:] = serie[i-num_lags_pass:i] for the last rows, where the future is not known.
+    """
+    len_serie = len(values)
+    X = np.zeros((len_serie, num_lags_pass + num_lags_fut))
+    y = np.zeros((len_serie, 1))
+    first_row = num_lags_pass + 1
+    last_full_row = len_serie - num_lags_fut + 1
+    start = max_lags_pass - num_lags_pass
+
+    if first_row < last_full_row:
+        X[first_row:last_full_row] = windows[first_row:last_full_row, start:max_lags_pass + num_lags_fut]
+
+    tail_row = max(first_row, last_full_row)
+    if tail_row < len_serie:
+        X[tail_row:, -num_lags_pass:] = windows[tail_row:, start:max_lags_pass]
+
+    y[first_row:, 0] = values[first_row:]
+
+    return X, y
+
+def lag_matrix(serie, num_lags_pass, num_lags_fut=0):
+    """
+        Returns X (len(serie) x (num_lags_pass+num_lags_fut)) and y (len(serie) x 1) lag matrices of serie,
+        X data are num_lags_pass behind and num_lags_fut ahead y data.
+    """
+    values = np.asarray(serie, dtype=float)
+    windows = _lag_windows(values, num_lags_pass, num_lags_fut)
+    return _fill_lag_matrix(windows, values, num_lags_pass, num_lags_pass, num_lags_fut)
+
+class LagFeatureStore:
+    """
+        Lag matrices of one time series for many different lags.
+        The zero padded serie is windowed once with a strided view of max_lags_pass+max_lags_fut columns,
+        every lag matrix is carved from it with one vectorized copy and kept (read only), and the
+        train and test splits handed out are views of the kept matrices.
+
+        serie - the time serie data
+        max_lags_pass - biggest number of lags behind y expected. The window grows if a bigger one is asked.
+        max_lags_fut - biggest number of lags ahead y expected. The window grows if a bigger one is asked.
+        tr_ts_percents - list of train and test percentages. E.G: [80,20]
+        maxsize - how many lag matrices are kept, the least recently used are dropped.
+    """
+    def __init__(self, serie, max_lags_pass=20, max_lags_fut=20, tr_ts_percents=[80,20], maxsize=64):
+        self._serie = serie
+        self._values = np.asarray(serie, dtype=float)
+        self._max_lags_pass = max_lags_pass
+        self._max_lags_fut = max_lags_fut
+        self._windows = _lag_windows(self._values, max_lags_pass, max_lags_fut)
+        self._tr_ts_percents = tr_ts_percents
+        self._maxsize = maxsize
+        self._matrices = OrderedDict()
+
+    def lags(self, num_lags_pass, num_lags_fut=0):
+        """
+            Returns the read only X and y lag matrices, see lag_matrix.
+        """
+        key = (num_lags_pass, num_lags_fut)
+        if key in self._matrices:
+            self._matrices.move_to_end(key)
+            return self._matrices[key]
+
+        if num_lags_pass > self._max_lags_pass or num_lags_fut > self._max_lags_fut:
+            self._max_lags_pass = max(num_lags_pass, self._max_lags_pass)
+            self._max_lags_fut = max(num_lags_fut, self._max_lags_fut)
+            self._windows = _lag_windows(self._values, self._max_lags_pass, self._max_lags_fut)
+
+        X, y = _fill_lag_matrix(self._windows, self._values, self._max_lags_pass, num_lags_pass, num_lags_fut)
+        X.setflags(write=False)
+        y.setflags(write=False)
+        self._matrices[key] = (X, y)
+        while len(self._matrices) > self._maxsize:
+            self._matrices.popitem(last=False)
+
+        return X, y
+
+    def split_lengths(self):
+        len_serie = len(self._values)
+        len_train = np.floor(len_serie*self._tr_ts_percents[0]/100).astype('int')
+        len_test = np.ceil(len_serie*self._tr_ts_percents[1]/100).astype('int')
+
+        return len_train, len_test
+
+    def train_test_split(self, num_lags):
+        """
+            Slipts the time series to train and test Data.
+            X data are data num_lags behind y data.
+        """
+        X, y = self.lags(num_lags)
+        len_train, len_test = self.split_lengths()
+
+        return X[0:len_train], y[0:len_train], X[len_train:len_train+len_test], y[len_train:len_train+len_test]
+
+    def train_test_split_prev(self, num_lags_pass, num_lags_fut):
+        """
+            Slipts the time series to train and test Data.
+            X data are data num_lags_pass behind and num_lags_fut ahead y data.
+            As before, y train is the serie itself.
+        """
+        X, y = self.lags(num_lags_pass, num_lags_fut)
+        len_train, len_test = self.split_lengths()
+
+        return X[0:len_train], self._serie[0:len_train], X[len_train:len_train+len_test], y[len_train:len_train+len_test]
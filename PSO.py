@@ -1,88 +1,139 @@
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from scipy.stats import qmc
 from tqdm import tqdm
-import random
-import math    # cos() for Rastrigin
-import copy    # array-copying convenience
 import sys     # max float
+import warnings
 
-class particle(object):
-    """
-    fitenessFunction : must be like, and returns a float from 0 to inf, the smaller means the better
-        result = fitenessFunction(self.Space(self.antsVertice[k_ant]), *fitnessFunctionArgs)
-        
-    fitnessFunctionArgs : args Diferent than the antsVertice in Space.    
+class swarm:
     """
-    def __init__(self, dim, minx, maxx, seed, function, functionArgs=[], verbose=False):
-        self.rnd = random.Random(seed)
-        self.position = [0.0]*dim
-        self.velocity = [0.0]*dim
-        self.best_part_pos = [0.0]*dim
-        self.fitnessFunction = function
-        self._fitnessFunctionArgs = functionArgs
+    Array backed swarm, row i of the (number_of_particles x dim) arrays position, velocity and best_part_pos
+    is the particle i, error and best_part_err hold their current and best errors.
 
-        for i in range(dim):
-            self.position[i] = ((maxx - minx) * self.rnd.random() + minx)
-            self.velocity[i] = ((maxx - minx) *self.rnd.random() + minx)
+    function : must be like, and returns a float from 0 to inf, the smaller means the better
+        result = function(position, functionArgs)
 
-        self.error = self.error_func() # curr error
-        self.best_part_pos = copy.copy(self.position) 
-        self.best_part_err = self.error # best error
+    functionArgs : args Diferent than the position.
 
-    def error_func(self):
-        self.error = self.fitnessFunction(self.position, self._fitnessFunctionArgs)
-        return self.error
+    batchFunction : optional, fitness of the whole swarm at once, used instead of function. Must be like
+        errors = batchFunction(positions, functionArgs)
+        where positions is the (number_of_particles x dim) array and errors has number_of_particles floats.
 
+    init_method : how the initial positions cover [minx, maxx]. 'uniform' draws every particle from its own
+        random stream, 'lhs' (latin hypercube) and 'sobol' spread them as a quasi random sample of the space.
+    """
+    INIT_METHODS = ['uniform', 'lhs', 'sobol']
 
-class swarm:
-    def __init__(self, number_of_particles, dim, minx, maxx, seed, function, functionArgs=[], verbose=False):
+    def __init__(self, number_of_particles, dim, minx, maxx, seed, function, functionArgs=[], verbose=False,
+                 batchFunction=None, init_method='uniform'):
         self.dim = dim
         self.minx = minx
         self.maxx = maxx
         self.seed = seed
         self.function = function
         self.functionArgs = functionArgs
+        self.batchFunction = batchFunction
         self.best_swarm_pos = None
         self.best_swarm_err = sys.float_info.max
         self.number_of_particles = number_of_particles
-        self.swarm = self.initializeSwarm()
+        if init_method not in self.INIT_METHODS:
+            raise Exception("init_method - choose between 'uniform', 'lhs' and 'sobol'")
+        self.init_method = init_method
+        # one independent stream per particle, plus the stream of the swarm used for sampling and updates
+        streams = np.random.SeedSequence(seed).spawn(number_of_particles + 1)
+        self.particle_rngs = [np.random.default_rng(stream) for stream in streams[:-1]]
+        self.rng = np.random.default_rng(streams[-1])
+        self.initializeSwarm()
+
+    def initialPositions(self):
+        """
+            (number_of_particles x dim) initial positions in [minx, maxx] from init_method.
+        """
+        if self.init_method == 'uniform':
+            sample = np.array([rng.random(self.dim) for rng in self.particle_rngs])
+        elif self.init_method == 'lhs':
+            sample = qmc.LatinHypercube(d=self.dim, seed=self.rng).random(self.number_of_particles)
+        else:
+            with warnings.catch_warnings():
+                # sobol points are balanced for powers of 2, any number of particles still covers the space
+                warnings.simplefilter('ignore', UserWarning)
+                sample = qmc.Sobol(d=self.dim, seed=self.rng).random(self.number_of_particles)
+
+        return self.minx + (self.maxx - self.minx)*sample
 
     def initializeSwarm(self):
-        Particle = particle(self.dim, self.minx, self.maxx, self.seed, self.function, self.functionArgs, verbose=False)
-        particles = [Particle for i in range(self.number_of_particles)]
-        return particles
+        # every particle starts from its own position and velocity
+        self.position = self.initialPositions()
+        self.velocity = np.array([(self.maxx - self.minx) * rng.random(self.dim) + self.minx for rng in self.particle_rngs])
+        self.error = self.error_func(self.position)
+        self.best_part_pos = self.position.copy()
+        self.best_part_err = self.error.copy()
+
+    def error_func(self, positions):
+        """
+            Errors of every row of positions, from batchFunction if given, else function row by row.
+        """
+        if self.batchFunction is not None:
+            return np.asarray(self.batchFunction(positions, self.functionArgs), dtype=float).reshape(-1)
+
+        return np.array([self.function(position.tolist(), self.functionArgs) for position in positions], dtype=float)
 
     def findGlobalBestInSwarm(self):
-        for i in range(self.number_of_particles): # check each particle
-            if self.swarm[i].error < self.best_swarm_err:
-                self.best_swarm_err = self.swarm[i].error
-                self.best_swarm_pos = copy.copy(self.swarm[i].position) 
-
-    def getDistanceBetweenParticles(self, p1, p2):
-        return sum([np.sqrt((p1.position[d]-p2.position[d])**2) for d in range(self.dim)])
-
-    def getLocalNeighbors(self, target_particle, N_neighbors):
-        distances_particle_list = []
-        for pts in self.swarm:
-            distances_particle_list.append((pts, self.getDistanceBetweenParticles(target_particle, pts)))
-        
-        distances_particle_list = sorted(distances_particle_list, key=lambda x: x[1])
-
-        return list(map(lambda tup_p_d: tup_p_d[0], distances_particle_list[1:]))
-
-    def findLocalBestForParticle(self, particle, numberOfClusters):
-        local_swarm = self.getLocalNeighbors(particle, numberOfClusters)
-        best_local_pos = local_swarm[0].position
-        local_best_swarm_err = local_swarm[0].error
-        
-        for i, pt in enumerate(local_swarm): # check each particle
-            if pt.error < local_best_swarm_err:
-                local_best_swarm_err = pt.error
-                best_local_pos = copy.copy(pt.position) 
-        
-        return best_local_pos
+        best = np.argmin(self.error)
+        if self.error[best] < self.best_swarm_err:
+            self.best_swarm_err = self.error[best]
+            self.best_swarm_pos = self.position[best].copy()
+
+    def getRingNeighbors(self, N_neighbors):
+        """
+            Static ring index, (number_of_particles x N_neighbors) array with the N_neighbors particles
+            around each particle in index order, half on each side.
+        """
+        N_neighbors = min(max(N_neighbors, 1), self.number_of_particles - 1)
+        offsets = np.arange(1, N_neighbors + 1)
+        offsets = np.where(offsets % 2 == 1, (offsets + 1)//2, -(offsets//2))
+
+        return (np.arange(self.number_of_particles)[:, None] + offsets) % self.number_of_particles
+
+    def getLocalNeighbors(self, N_neighbors, block_size=1024):
+        """
+            (number_of_particles x N_neighbors) array with the N_neighbors nearest particles of each particle
+            (manhattan distance), not counting itself. Few dimentions and neighbors use a KD-tree, the others a
+            top-k over blocks of the pairwise distance matrix, which is faster there.
+        """
+        N_neighbors = min(max(N_neighbors, 1), self.number_of_particles - 1)
+        indexes = np.arange(self.number_of_particles)
+
+        if self.dim <= 5 and N_neighbors <= max(64, self.number_of_particles//100):
+            _, neighbors = cKDTree(self.position).query(self.position, k=N_neighbors + 1, p=1)
+            neighbors = neighbors.reshape(self.number_of_particles, -1)
+        else:
+            neighbors = np.empty((self.number_of_particles, N_neighbors + 1), dtype=int)
+            for start in range(0, self.number_of_particles, block_size):
+                distances = cdist(self.position[start:start + block_size], self.position, 'cityblock')
+                neighbors[start:start + block_size] = np.argpartition(distances, N_neighbors, axis=1)[:, :N_neighbors + 1]
+
+        # drops the particle itself, or the last one when ties left it out
+        keep = neighbors != indexes[:, None]
+        keep[keep.all(axis=1), -1] = False
+
+        return neighbors[keep].reshape(self.number_of_particles, N_neighbors)
+
+    def findLocalBest(self, neighbors):
+        """
+            Returns the (number_of_particles x dim) positions of the best particle of each row of neighbors.
+        """
+        if self.number_of_particles < 2:
+            return self.position.copy()
+
+        best = neighbors[np.arange(self.number_of_particles), np.argmin(self.error[neighbors], axis=1)]
+
+        return self.position[best]
 
 class PSO(swarm):
-    def __init__(self, number_of_particles, dim, minx, maxx, seed, function, functionArgs=[], verbose=False):
+    def __init__(self, number_of_particles, dim, minx, maxx, seed, function, functionArgs=[], verbose=False,
+                 batchFunction=None, init_method='uniform'):
         """
         number_of_particle - number of particles to chose
         dim - dimention of the problem, space of search
@@ -91,23 +142,32 @@ class PSO(swarm):
         seed - random seed generator
         function - function to be optimized (must be of sabe dimention as dim)
         functionArgs - Extra arguments for the function to be optimized
+        batchFunction - optional, function that evaluates all the particles at once, see swarm.
+        init_method - 'uniform', 'lhs' or 'sobol' initial positions, see swarm.
         """
-        super(PSO, self).__init__(number_of_particles, dim, minx, maxx, seed, function, functionArgs=[], verbose=False)
+        super(PSO, self).__init__(number_of_particles, dim, minx, maxx, seed, function, functionArgs=functionArgs,
+                                  verbose=verbose, batchFunction=batchFunction, init_method=init_method)
         self.historic_best_pos = []
         self.historic_best_error = []
 
     def update_particle_velocity(self, p_v, p_best, p_pos, g_best, c1, r1, c2, r2, w):
-        return (w * p_v) + (c1 * r1 * (p_best - p_pos)) +  (c2 * r2 * (g_best - p_pos)) 
+        return (w * p_v) + (c1 * r1 * (p_best - p_pos)) +  (c2 * r2 * (g_best - p_pos))
 
-    def Solver(self, max_epochs, plot_at_every=50, w=0.8, c1=2.05, c2=2.05, topology='G'):
+    def Solver(self, max_epochs, plot_at_every=50, w=0.8, c1=2.05, c2=2.05, topology='G', neighborhood='spatial',
+               N_neighbors=None):
         """
         max_epochs - the number of epochs to search
         w - the inertial coefficient. It must be under 1, and float or tuple type. If tuple, (wi, wf), the algorithm will linearly decay the inertial coefficient over the epochs til the final value.
         c1 - the cognitive coefficient
         c2 - the social coefficient
         topology - choose between chars 'G':"Global" 'L':"Local or Ring" 'F':"Focal or Wheel".
+        neighborhood - neighbors of a particle on 'L' topology. 'spatial' for the N_neighbors nearest particles,
+            found again every epoch, or 'ring' for the N_neighbors around it in index order, which never change.
+        N_neighbors - size of the neighborhoods on 'L' topology, None for a third of the particles.
+
+        All the particles move at once every epoch, from the bests known at the start of the epoch.
         """
-        
+
         self.historic_best_error = []
 
         if isinstance(w, tuple):
@@ -117,16 +177,18 @@ class PSO(swarm):
                 raise Exception("w must be lower than 1 and bigger than 0")
             else:
                 w_array = [w]*max_epochs
-        
-        if topology == 'G':
-            foo = "bar"
-        elif topology == 'F':
-            foo = "bar"
-        elif topology == 'L':
-            numberOfClusters = int(self.number_of_particles/3)
-        else:
+
+        if topology not in ['G', 'F', 'L']:
             raise Exception("Wrong char for topology choice, please choose between chars 'G':'Global' 'L':'Local or Ring' 'F':'Focal or Wheel'.")
-        
+
+        if N_neighbors is None:
+            N_neighbors = int(self.number_of_particles/3)
+
+        if neighborhood == 'ring':
+            ring_neighbors = self.getRingNeighbors(N_neighbors)
+        elif neighborhood != 'spatial':
+            raise Exception("neighborhood - choose between 'spatial' and 'ring'")
+
         plot_follow = plot_at_every
         for epoch in tqdm(range(max_epochs)):
             # Topology
@@ -134,54 +196,38 @@ class PSO(swarm):
             self.historic_best_error.append(self.best_swarm_err)
             self.historic_best_pos.append(self.best_swarm_pos)
 
-            for i in range(self.number_of_particles): # process each particle
-                # compute new velocity of curr particle
-                pt = self.swarm[i]
-                
-                # Topology
-                if topology == 'G':
-                    reference_pos = copy.copy(self.best_swarm_pos)
-                elif topology == 'F':
-                    reference_pos = copy.copy(self.swarm[0].position)
-                elif topology == 'L':
-                    reference_pos = copy.copy(self.findLocalBestForParticle(pt, numberOfClusters))
-
-                for k in range(self.dim): 
-                    r1 = pt.rnd.random()    # randomizations
-                    r2 = pt.rnd.random()
-                
-                    pt.velocity[k] = self.update_particle_velocity(pt.velocity[k], pt.best_part_pos[k], pt.position[k], reference_pos[k], c1,r1,c2,r2, w_array[epoch])
-
-                    if pt.velocity[k] < self.minx:
-                        pt.velocity[k] = self.minx
-                    elif pt.velocity[k] > self.maxx:
-                        pt.velocity[k] = self.maxx
-
-                # compute new position using new velocity
-                for k in range(self.dim): 
-                    pt.position[k] += pt.velocity[k]
-            
-                # compute error of new position
-                pt.error_func()
-
-                # is new position a new best for the particle?
-                if pt.error < pt.best_part_err:
-                    pt.best_part_err = pt.error
-                    pt.best_part_pos = copy.copy(pt.position)
-
-                # update swarm
-                self.swarm[i] = copy.copy(pt)   
-                # is new position a new best overall?
-                if self.swarm[i].error < self.best_swarm_err:
-                    self.best_swarm_err = self.swarm[i].error
-                    self.best_swarm_pos = copy.copy(self.swarm[i].position) 
-
-            # self.findGlobalBestInSwarm()
-            # self.historic_best_error.append(self.best_swarm_err)
-            # self.historic_best_pos.append(self.best_swarm_pos)
-            
+            if topology == 'G':
+                reference_pos = self.best_swarm_pos
+            elif topology == 'F':
+                reference_pos = self.position[0].copy()
+            elif topology == 'L' and neighborhood == 'ring':
+                reference_pos = self.findLocalBest(ring_neighbors)
+            elif topology == 'L':
+                reference_pos = self.findLocalBest(self.getLocalNeighbors(N_neighbors))
+
+            # compute new velocities, randomizations for every particle and dimention
+            r1 = self.rng.random((self.number_of_particles, self.dim))
+            r2 = self.rng.random((self.number_of_particles, self.dim))
+            self.velocity = self.update_particle_velocity(self.velocity, self.best_part_pos, self.position, reference_pos,
+                                                          c1, r1, c2, r2, w_array[epoch])
+            np.clip(self.velocity, self.minx, self.maxx, out=self.velocity)
+
+            # compute new positions using new velocities
+            self.position += self.velocity
+
+            # compute error of new positions
+            self.error = self.error_func(self.position)
+
+            # are new positions new bests for the particles?
+            improved = self.error < self.best_part_err
+            self.best_part_err[improved] = self.error[improved]
+            self.best_part_pos[improved] = self.position[improved]
+
+            # is a new position a new best overall?
+            self.findGlobalBestInSwarm()
+
             if epoch > plot_follow:
                 print("Epoch: {0}, best error: {1:.3f}, best pos: {2}".format(epoch, self.best_swarm_err, self.best_swarm_pos))
                 plot_follow += plot_at_every
-                
+
         return self
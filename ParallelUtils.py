@@ -0,0 +1,46 @@
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from threadpoolctl import threadpool_limits
+
+EXECUTORS = ['serial', 'thread', 'process']
+
+def _limit_worker_threads(inner_threads):
+    threadpool_limits(limits=inner_threads)
+
+@contextmanager
+def executor_scope(executor='serial', n_jobs=None, inner_threads=None):
+    """
+        Yields the pool used to evaluate a batch of independent tasks.
+
+        executor - 'serial', 'thread', 'process' or an already created concurrent.futures.Executor.
+            Pools created here are shut down on exit, an Executor passed in is left open for its owner.
+
+        n_jobs - number of workers for the 'thread' and 'process' pools. None uses all the cpus.
+
+        inner_threads - cap on the BLAS/OpenMP threads of every task of a 'thread' or 'process' pool created here,
+            so n_jobs workers do not start a thread per cpu each. None leaves them as they are.
+
+        Yields None for serial runs.
+    """
+    if executor is None or isinstance(executor, Executor) or executor == 'serial':
+        yield executor
+    elif executor == 'thread':
+        limits = threadpool_limits(limits=inner_threads) if inner_threads is not None else nullcontext()
+        with limits, ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            yield pool
+    elif executor == 'process':
+        initializer = _limit_worker_threads if inner_threads is not None else None
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=(inner_threads,)) as pool:
+            yield pool
+    else:
+        raise Exception("executor - choose between 'serial', 'thread', 'process' or a concurrent.futures.Executor object")
+
+def parallel_map(function, *iterables, executor=None, chunksize=1):
+    """
+        Same as list(map(function, *iterables)), but evaluated on the executor pool if one is given.
+        Results always come back in the order of the iterables.
+    """
+    if executor is None or executor == 'serial':
+        return list(map(function, *iterables))
+
+    return list(executor.map(function, *iterables, chunksize=chunksize))
@@ -0,0 +1,100 @@
+import numpy as np
+import time
+
+class SearchScheduler:
+    """
+        Spreads a compute budget of a nested GA (e.g. AGMLP_Residual) between the outer individuals
+        and the inner searches each of them runs.
+
+        max_fits - total model fits allowed for all inner searches. None for no limit.
+        max_seconds - wall time allowed for the whole search. None for no limit.
+        min_effort - fraction of the inner generations*population that the weakest outer candidate of a
+            generation gets, the best one gets the full share.
+    """
+    def __init__(self, max_fits=None, max_seconds=None, min_effort=0.25):
+        self._max_fits = max_fits
+        self._max_seconds = max_seconds
+        self._min_effort = min_effort
+        self._start_time = None
+        self._remaining_evaluations = 0
+        self._spent = {}
+
+    def start(self, planned_evaluations):
+        """
+            planned_evaluations - how many outer individuals the search expects to evaluate.
+        """
+        self._start_time = time.time()
+        self._remaining_evaluations = planned_evaluations
+        self._spent = {'outer': {'evaluations': 0, 'seconds': 0.0}}
+
+    def elapsed(self):
+        return time.time() - self._start_time
+
+    def fits(self):
+        return sum(level.get('fits', 0) for level in self._spent.values())
+
+    def remaining_fits(self):
+        """
+            Fits still allowed. The time budget is turned into fits with the mean seconds per fit seen so far.
+        """
+        remaining = np.inf
+        if self._max_fits is not None:
+            remaining = self._max_fits - self.fits()
+
+        if self._max_seconds is not None:
+            inner_seconds = sum(level['seconds'] for name, level in self._spent.items() if name != 'outer')
+            seconds_per_fit = inner_seconds/self.fits() if self.fits() > 0 else 0
+            remaining_seconds = self._max_seconds - self.elapsed()
+            if remaining_seconds <= 0:
+                remaining = 0
+            elif seconds_per_fit > 0:
+                remaining = min(remaining, remaining_seconds/seconds_per_fit)
+
+        return max(remaining, 0)
+
+    def exhausted(self):
+        return self.remaining_fits() <= 0
+
+    def inner_settings(self, num_generations, size_population, inner_searches, rank=0, n_candidates=1):
+        """
+            Returns (num_generations, size_population) for the inner searches of one outer individual.
+
+            num_generations, size_population - settings of a full inner search.
+            inner_searches - how many inner searches the individual runs.
+            rank, n_candidates - position of the individual among the candidates of its generation,
+                0 is the most promising one. Lower ranks get more effort.
+        """
+        full_cost = inner_searches*size_population*(num_generations + 1)
+        share = self.remaining_fits()/max(self._remaining_evaluations, 1)
+        effort = min(1.0, share/full_cost)
+        if n_candidates > 1:
+            effort = effort*(1 - (1 - self._min_effort)*rank/(n_candidates - 1))
+
+        # fits of a GA grow with generations*population, both are scaled by sqrt(effort)
+        scale = np.sqrt(effort)
+        return int(round(num_generations*scale)), max(2, int(round(size_population*scale)))
+
+    def spend(self, level, fits=0, seconds=0.0):
+        """
+            Charges fits and seconds to level.
+        """
+        spent = self._spent.setdefault(level, {'fits': 0, 'seconds': 0.0})
+        spent['fits'] += fits
+        spent['seconds'] += seconds
+
+    def evaluated(self, seconds):
+        """
+            Charges one outer evaluation that took seconds.
+        """
+        self._remaining_evaluations -= 1
+        self._spent['outer']['evaluations'] += 1
+        self._spent['outer']['seconds'] += seconds
+
+    def report(self):
+        """
+            Returns the spend per level, plus the totals.
+        """
+        report = {level: dict(spent) for level, spent in self._spent.items()}
+        report['total'] = {'fits': self.fits(), 'seconds': self.elapsed()}
+
+        return report
@@ -1,4 +1,5 @@
 from mlopt.ACO import ACO
+from mlopt.LagFeatureStore import lag_matrix
 import pyswarms as ps
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 import numpy as np
@@ -37,12 +38,7 @@ def train_test_split(serie, num_lags, tr_vd_ts_percents = [80, 20], print_shapes
         print_shapes : True chose to print final shapes. Default is False.
     """
     len_serie = len(serie)
-    X = np.zeros((len_serie, num_lags))
-    y = np.zeros((len_serie,1))
-    for i in np.arange(0, len_serie):
-        if i-num_lags>0:
-            X[i,:] = serie[i-num_lags:i]
-            y[i] = serie[i]
+    X, y = lag_matrix(serie, num_lags)
     
     len_train = np.floor(len_serie*tr_vd_ts_percents[0]/100).astype('int')
     len_test = np.ceil(len_serie*tr_vd_ts_percents[1]/100).astype('int')
@@ -70,15 +66,7 @@ def train_test_split_prev(serie, num_lags_pass, num_lags_fut, tr_vd_ts_percents
         print_shapes : True chose to print final shapes. Default is False.
     """
     len_serie = len(serie)
-    X = np.zeros((len_serie, (num_lags_pass+num_lags_fut)))
-    y = np.zeros((len_serie,1))
-    for i in np.arange(0, len_serie):
-        if (i-num_lags_pass > 0) and ((i+num_lags_fut) <= len_serie):
-            X[i,:] = serie[i-num_lags_pass:i+num_lags_fut]
-            y[i] = serie[i]
-        elif (i-num_lags_pass > 0) and ((i+num_lags_fut) > len_serie):
-            X[i,-num_lags_pass:] = serie[i-num_lags_pass:i]
-            y[i] = serie[i]
+    X, y = lag_matrix(serie, num_lags_pass, num_lags_fut)
     
     len_train = np.floor(len_serie*tr_vd_ts_percents[0]/100).astype('int')
     len_test = np.ceil(len_serie*tr_vd_ts_percents[1]/100).astype('int')
@@ -193,6 +181,7 @@ def sarimax_ACO_search(endo_var, exog_var_matrix, searchSpace, options_ACO, verb
         
         options_ACO: parametrization for ACO algorithm. EG:
             {'antNumber':2, 'antTours':1, 'alpha':2, 'beta':2, 'rho':0.5, 'Q':2}
+            optional 'executor' ('serial' or 'thread') and 'n_jobs' fit the SARIMAX models of a tour in parallel.
     """
     def SARIMAX_aicc(X, *args):
         endo = args[0][0]
@@ -233,7 +222,7 @@ def sarimax_ACO_search(endo_var, exog_var_matrix, searchSpace, options_ACO, verb
     
     X = searchSpace
     warnings.filterwarnings("ignore") # specify to ignore warning messages
-    ACOsearch = ACO(alpha, beta, rho, Q)
+    ACOsearch = ACO(alpha, beta, rho, Q, executor=options_ACO.get('executor', 'serial'), n_jobs=options_ACO.get('n_jobs'))
 
     best_result, _ = ACOsearch.optimize(antNumber, antTours, dimentionsRanges=X, function=SARIMAX_aicc,
                                         functionArgs=[endo_var, exog_var_matrix],  verbose=verbose)
@@ -375,6 +364,7 @@ def sarimax_ACO_PDQ_search(endo_var, exog_var_matrix, PDQS, searchSpace, options
         
         options_ACO: parametrization for ACO algorithm. E.G.:
             {'antNumber':2, 'antTours':1, 'alpha':2, 'beta':2, 'rho':0.5, 'Q':2}
+            optional 'executor' ('serial' or 'thread') and 'n_jobs' fit the SARIMAX models of a tour in parallel.
     """
     def SARIMAX_AICc(X, *args):
         endo = args[0][0]
@@ -407,7 +397,7 @@ def sarimax_ACO_PDQ_search(endo_var, exog_var_matrix, PDQS, searchSpace, options
         logging.info("Original search Space: {0}".format(searchSpace))
 
     warnings.filterwarnings("ignore") # specify to ignore warning messages
-    ACOsearch = ACO(alpha, beta, rho, Q)
+    ACOsearch = ACO(alpha, beta, rho, Q, executor=options_ACO.get('executor', 'serial'), n_jobs=options_ACO.get('n_jobs'))
     best_result, _ = ACOsearch.optimize(antNumber, antTours, dimentionsRanges=searchSpace, function=SARIMAX_AICc,
                                         functionArgs=[endo_var, exog_var_matrix, PDQS],  verbose=verbose)
     
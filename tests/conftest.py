@@ -0,0 +1,12 @@
+import importlib.util
+import os
+import sys
+
+# the modules import each other as mlopt.<module>, so a checkout that is not installed is loaded as mlopt
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if importlib.util.find_spec('mlopt') is None:
+    spec = importlib.util.spec_from_file_location('mlopt', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    sys.modules['mlopt'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['mlopt'])
@@ -0,0 +1,33 @@
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+from mlopt.EnsembleSearch import EnsembleSearch
+
+
+def run_search(executor):
+    rng = np.random.RandomState(0)
+    X = rng.rand(80, 4)
+    y = X @ np.array([1, 2, -1, .5]) + .05*rng.rand(80)
+
+    random.seed(0)
+    np.random.seed(0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        search = EnsembleSearch(X[:60], y[:60], X[60:], y[60:], epochs=3, size_pop=6, verbose=False,
+                                executor=executor, n_jobs=2).search_best()
+
+    return search._fitness_array, search._n_fits, np.random.rand()
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_pool_runs_match_serial(executor):
+    # SVR members seed themselves from the global np.random, the search must leave it as a serial run does
+    fitness, n_fits, next_draw = run_search(executor)
+    serial_fitness, serial_n_fits, serial_next_draw = run_search('serial')
+
+    np.testing.assert_array_equal(fitness, serial_fitness)
+    assert n_fits == serial_n_fits
+    assert next_draw == serial_next_draw